@@ -0,0 +1,119 @@
+import json
+import logging
+from datetime import datetime
+from typing import BinaryIO
+
+import numpy as np
+import pandas as pd
+
+from .storage import COLUMNAS, Registro
+
+logger = logging.getLogger("starlab2")
+
+# Mismas reglas de longitud que el formulario de /registrar
+REGLAS = {"Nombre": (2, 100), "Licencia": (5, 20), "Vehiculo": (2, 50)}
+CHUNK_FILAS = 10_000
+
+def leer_por_bloques(archivo: BinaryIO, formato: str, chunksize: int = CHUNK_FILAS):
+    """Itera DataFrames de `chunksize` filas (todo como texto) sin cargar el fichero entero."""
+    if formato == "ndjson":
+        yield from _bloques_ndjson(archivo, chunksize)
+        return
+    if formato != "csv":
+        raise ValueError(f"Formato no soportado: {formato} (usa csv o ndjson)")
+    with pd.read_csv(archivo, chunksize=chunksize, dtype=str, keep_default_na=False, encoding="utf-8-sig", skipinitialspace=True) as lector:
+        yield from lector
+
+def _bloques_ndjson(archivo: BinaryIO, chunksize: int):
+    # json línea a línea en vez de pd.read_json: este infiere números aunque dtype=False
+    # (una licencia 12345 en un bloque con nulos acababa como "12345.0")
+    filas = []
+    for n, linea in enumerate(archivo, 1):
+        if not linea.strip():
+            continue
+        fila = json.loads(linea)
+        if not isinstance(fila, dict):
+            raise ValueError(f"Línea {n}: se esperaba un objeto JSON")
+        filas.append({k: "" if v is None else str(v) for k, v in fila.items()})
+        if len(filas) == chunksize:
+            yield pd.DataFrame(filas, dtype=str)
+            filas = []
+    if filas:
+        yield pd.DataFrame(filas, dtype=str)
+
+def _columnas(df: pd.DataFrame) -> pd.DataFrame:
+    renombres = {c: col for c in df.columns for col in REGLAS if str(c).strip().lower() == col.lower()}
+    faltan = [col for col in REGLAS if col not in renombres.values()]
+    if faltan:
+        raise ValueError(f"Faltan columnas: {', '.join(faltan)}")
+    return df.rename(columns=renombres)[list(REGLAS)]
+
+def _en(serie: pd.Series, conjunto: set[str]) -> np.ndarray:
+    # Series.isin convierte el conjunto entero en cada llamada; `vistas` crece con cada bloque
+    return np.fromiter((x in conjunto for x in serie), dtype=bool, count=len(serie))
+
+def _registros(columnas: dict) -> list[dict]:
+    claves = list(columnas)
+    return [dict(zip(claves, fila)) for fila in zip(*(list(v) for v in columnas.values()))]
+
+def validar_bloque(df: pd.DataFrame, vistas: set[str], registro: Registro) -> tuple[pd.DataFrame, np.ndarray, np.ndarray]:
+    """Normaliza y valida un bloque de forma vectorizada.
+
+    Devuelve el bloque normalizado y, por fila, su estado ("valido", "invalido",
+    "duplicado") y el motivo. `vistas` acumula las licencias válidas de bloques previos.
+    """
+    df = _columnas(df)
+    limpio = {col: df[col].fillna("").astype(str).str.strip() for col in REGLAS}
+    norm = pd.DataFrame({
+        "Nombre": limpio["Nombre"].str.title(),
+        "Licencia": limpio["Licencia"].str.upper(),
+        "Vehiculo": limpio["Vehiculo"].str.title(),
+    }, index=df.index)
+
+    condiciones, motivos = [], []
+    for col, (minimo, maximo) in REGLAS.items():
+        largo = limpio[col].str.len()
+        condiciones.append((largo < minimo) | (largo > maximo))
+        motivos.append(f"{col} debe tener entre {minimo} y {maximo} caracteres")
+    invalido = np.logical_or.reduce(condiciones)
+
+    lic = norm["Licencia"]
+    repetida_en_lote = (lic.duplicated().to_numpy() | _en(lic, vistas)) & ~invalido
+    candidatas = lic[~invalido & ~repetida_en_lote]
+    ya_registrada = _en(lic, registro.existentes(candidatas)) & ~invalido & ~repetida_en_lote
+
+    estado = np.select([invalido, repetida_en_lote, ya_registrada], ["invalido", "duplicado", "duplicado"], "valido")
+    motivo = np.select(condiciones + [repetida_en_lote, ya_registrada], motivos + ["Licencia repetida en el archivo", "Licencia ya registrada"], "")
+    vistas.update(lic[estado == "valido"])
+    return norm, estado, motivo
+
+def importar_masivo(archivo: BinaryIO, formato: str, registro: Registro) -> dict:
+    """Importa un CSV/NDJSON de conductores en una sola escritura y devuelve el informe por fila."""
+    vistas: set[str] = set()
+    pendientes, informe = [], []
+    fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    offset = 0
+    for bloque in leer_por_bloques(archivo, formato):
+        norm, estado, motivo = validar_bloque(bloque, vistas, registro)
+        validas = norm[estado == "valido"]
+        pendientes.extend(_registros({c: (validas[c] if c in validas else [fecha] * len(validas)) for c in COLUMNAS}))
+        informe.append(pd.DataFrame({"fila": np.arange(offset + 1, offset + len(norm) + 1), "licencia": norm["Licencia"].to_numpy(), "estado": estado, "motivo": motivo}))
+        offset += len(norm)
+
+    insertados = {fila["Licencia"] for fila in registro.insertar(pendientes)} if pendientes else set()
+    informe = pd.concat(informe, ignore_index=True) if informe else pd.DataFrame(columns=["fila", "licencia", "estado", "motivo"])
+    # Otra alta pudo entrar entre la validación y la escritura
+    perdidas = (informe["estado"] == "valido").to_numpy() & ~_en(informe["licencia"], insertados)
+    informe.loc[perdidas, ["estado", "motivo"]] = ["duplicado", "Licencia ya registrada"]
+    informe.loc[informe["estado"] == "valido", "estado"] = "importado"
+
+    conteo = informe["estado"].value_counts()
+    logger.info(f"Carga masiva: {len(insertados)}/{len(informe)} conductores importados")
+    return {
+        "ok": True,
+        "recibidos": len(informe),
+        "importados": int(conteo.get("importado", 0)),
+        "duplicados": int(conteo.get("duplicado", 0)),
+        "invalidos": int(conteo.get("invalido", 0)),
+        "filas": _registros({c: informe[c].tolist() for c in informe.columns}),
+    }
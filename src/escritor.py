@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import os
+
+from starlette.concurrency import run_in_threadpool
+
+from .storage import Registro, normalizar_conductor
+
+logger = logging.getLogger("starlab2")
+
+class EscritorRegistro:
+    """Único escritor del registro: agrupa las altas de una cola y las confirma por lotes.
+
+    Cada lote se guarda con una sola llamada a `Registro.insertar` (un fsync / una
+    transacción). El lote se cierra al llegar a `lote_max` filas o cuando han pasado
+    `latencia_ms` desde la primera alta pendiente.
+    """
+
+    def __init__(self, registro: Registro, latencia_ms: float | None = None, lote_max: int | None = None):
+        self.registro = registro
+        self.latencia = (latencia_ms if latencia_ms is not None else float(os.getenv("ESCRITOR_LATENCIA_MS", "5"))) / 1000
+        self.lote_max = lote_max or int(os.getenv("ESCRITOR_LOTE_MAX", "500"))
+        self._cola: asyncio.Queue | None = None
+        self._tarea: asyncio.Task | None = None
+
+    def iniciar(self):
+        if self._tarea is None or self._tarea.done():
+            self._cola = asyncio.Queue()
+            self._tarea = asyncio.get_running_loop().create_task(self._bucle())
+
+    async def detener(self):
+        if self._tarea is None:
+            return
+        await self._cola.put(None)
+        await self._tarea
+        self._tarea = None
+
+    async def agregar(self, nombre: str, licencia: str, vehiculo: str):
+        """Encola un alta y espera su resultado: la fila guardada o None si la licencia ya existe."""
+        self.iniciar()
+        futuro = asyncio.get_running_loop().create_future()
+        await self._cola.put((normalizar_conductor(nombre, licencia, vehiculo), futuro))
+        return await futuro
+
+    async def _bucle(self):
+        loop = asyncio.get_running_loop()
+        parar = False
+        while not parar:
+            item = await self._cola.get()
+            if item is None:
+                break
+            lote = [item]
+            limite = loop.time() + self.latencia
+            while len(lote) < self.lote_max:
+                try:
+                    item = self._cola.get_nowait() if loop.time() >= limite else await asyncio.wait_for(self._cola.get(), limite - loop.time())
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if item is None:
+                    parar = True
+                    break
+                lote.append(item)
+            await self._confirmar(lote)
+
+    async def _confirmar(self, lote):
+        try:
+            insertados = await run_in_threadpool(self.registro.insertar, [fila for fila, _ in lote])
+        except Exception as e:
+            logger.error(f"Error guardando lote de {len(lote)} registros: {e}")
+            for _, futuro in lote:
+                if not futuro.done():
+                    futuro.set_exception(e)
+            return
+        guardados = {id(fila) for fila in insertados}
+        for fila, futuro in lote:
+            if not futuro.done():
+                futuro.set_result(fila if id(fila) in guardados else None)
+        if len(lote) > 1:
+            logger.info(f"Lote confirmado: {len(insertados)}/{len(lote)} registros")
@@ -0,0 +1,130 @@
+import csv
+import io
+import json
+import os
+import tempfile
+from typing import Iterable, Iterator
+
+# Formato -> (media type, extensión, admite Range). XLSX y Parquet no son byte a byte
+# reproducibles (metadatos con fecha), así que se sirven completos y con ETag débil.
+FORMATOS = {
+    "csv": ("text/csv", "csv", True),
+    "ndjson": ("application/x-ndjson", "ndjson", True),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx", False),
+    "parquet": ("application/vnd.apache.parquet", "parquet", False),
+}
+
+LOTE = 1000
+CHUNK = 64 * 1024
+
+def generar_csv(filas: Iterable[dict], columnas: list[str]) -> Iterator[bytes]:
+    buf = io.StringIO()
+    w = csv.writer(buf, lineterminator="\n")
+    w.writerow(columnas)
+    for n, fila in enumerate(filas, 1):
+        w.writerow([fila.get(c, "") for c in columnas])
+        if n % LOTE == 0:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0); buf.truncate()
+    yield buf.getvalue().encode("utf-8")
+
+def generar_ndjson(filas: Iterable[dict], columnas: list[str]) -> Iterator[bytes]:
+    lote = []
+    for fila in filas:
+        lote.append(json.dumps({c: fila.get(c, "") for c in columnas}, ensure_ascii=False))
+        if len(lote) == LOTE:
+            yield ("\n".join(lote) + "\n").encode("utf-8")
+            lote = []
+    if lote:
+        yield ("\n".join(lote) + "\n").encode("utf-8")
+
+def _servir_temporal(escribir) -> Iterator[bytes]:
+    """Escribe en un temporal con `escribir(path)` y lo emite por trozos; luego lo borra."""
+    fd, path = tempfile.mkstemp(prefix="starlab_export_")
+    os.close(fd)
+    try:
+        escribir(path)
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK):
+                yield chunk
+    finally:
+        os.unlink(path)
+
+def generar_xlsx(filas: Iterable[dict], columnas: list[str]) -> Iterator[bytes]:
+    import xlsxwriter
+
+    def escribir(path):
+        # constant_memory: cada fila se vuelca a disco en cuanto se pasa a la siguiente
+        wb = xlsxwriter.Workbook(path, {"constant_memory": True})
+        ws = wb.add_worksheet("Conductores")
+        ws.write_row(0, 0, columnas)
+        for n, fila in enumerate(filas, 1):
+            ws.write_row(n, 0, [fila.get(c, "") for c in columnas])
+        wb.close()
+    return _servir_temporal(escribir)
+
+def generar_parquet(filas: Iterable[dict], columnas: list[str]) -> Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    def escribir(path):
+        schema = pa.schema([(c, pa.string()) for c in columnas])
+        with pq.ParquetWriter(path, schema) as writer:
+            lote = []
+            for fila in filas:
+                lote.append(fila)
+                if len(lote) == 10 * LOTE:
+                    writer.write_table(pa.Table.from_pylist([{c: f.get(c, "") for c in columnas} for f in lote], schema=schema))
+                    lote = []
+            if lote:
+                writer.write_table(pa.Table.from_pylist([{c: f.get(c, "") for c in columnas} for f in lote], schema=schema))
+    return _servir_temporal(escribir)
+
+GENERADORES = {"csv": generar_csv, "ndjson": generar_ndjson, "xlsx": generar_xlsx, "parquet": generar_parquet}
+
+def formato_disponible(formato: str) -> bool:
+    modulo = {"xlsx": "xlsxwriter", "parquet": "pyarrow"}.get(formato)
+    if modulo is None:
+        return True
+    try:
+        __import__(modulo)
+        return True
+    except ImportError:
+        return False
+
+def parsear_rango(valor: str | None):
+    """Interpreta un único rango `bytes=a-b` / `bytes=a-`. Devuelve (inicio, fin|None) o None."""
+    if not valor or not valor.startswith("bytes=") or "," in valor:
+        return None
+    inicio, _, fin = valor[len("bytes="):].strip().partition("-")
+    if not inicio.isdigit() or (fin and not fin.isdigit()):
+        return None
+    inicio, fin = int(inicio), (int(fin) if fin else None)
+    if fin is not None and fin < inicio:
+        return None
+    return inicio, fin
+
+def volcar_temporal(chunks: Iterable[bytes]) -> tuple[str, int]:
+    """Escribe un flujo de trozos en un temporal; devuelve (ruta, tamaño). Lo borra servir_fichero(borrar=True)."""
+    fd, path = tempfile.mkstemp(prefix="starlab_export_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+            return path, f.tell()
+    except BaseException:
+        os.unlink(path)
+        raise
+
+def servir_fichero(path, inicio: int, fin: int, borrar: bool = False) -> Iterator[bytes]:
+    """Emite los bytes [inicio, fin] (fin incluido) de un fichero por trozos."""
+    try:
+        with open(path, "rb") as f:
+            f.seek(inicio)
+            quedan = fin + 1 - inicio
+            while quedan > 0 and (chunk := f.read(min(CHUNK, quedan))):
+                quedan -= len(chunk)
+                yield chunk
+    finally:
+        if borrar:
+            os.unlink(path)
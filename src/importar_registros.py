@@ -0,0 +1,64 @@
+"""Importación única de los registros antiguos (CSV y JSON de AutoServe) al backend configurado.
+
+Uso: DB_URL=sqlite:///data/registro.db python -m src.importar_registros [--csv RUTA] [--json RUTA]
+"""
+import argparse
+import csv
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+
+from .storage import crear_registro, normalizar_conductor
+
+logger = logging.getLogger("starlab2")
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+CSV_PATH = BASE_DIR / "data" / "registro.csv"
+JSON_PATH = Path.home() / ".starlabpw" / "data" / "registros.json"
+
+def filas_csv(path: Path):
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            if row.get("Licencia"):
+                yield normalizar_conductor(row.get("Nombre") or "", row["Licencia"], row.get("Vehiculo") or "", row.get("FechaRegistro") or None)
+
+def filas_json(path: Path):
+    with open(path, "r", encoding="utf-8") as f:
+        registros = json.load(f)
+    for r in registros:
+        if not r.get("licencia"):
+            continue
+        fecha = None
+        if r.get("timestamp"):
+            try:
+                fecha = datetime.fromisoformat(r["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                pass
+        yield normalizar_conductor(r.get("nombre") or "", r["licencia"], r.get("vehiculo") or "", fecha)
+
+def importar(registro, csv_path: Path | None = CSV_PATH, json_path: Path | None = JSON_PATH) -> dict:
+    """Copia los registros de las fuentes existentes; las licencias ya presentes se omiten."""
+    registro.cargar()
+    resumen = {}
+    for nombre, path, lector in (("csv", csv_path, filas_csv), ("json", json_path, filas_json)):
+        if path is None or not Path(path).exists():
+            continue
+        if nombre == "csv" and getattr(registro, "path", None) == Path(path):
+            continue
+        filas = list(lector(Path(path)))
+        insertados = registro.insertar(filas)
+        resumen[nombre] = {"leidos": len(filas), "importados": len(insertados)}
+        logger.info(f"Importados {len(insertados)}/{len(filas)} registros desde {path}")
+    return resumen
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    ap = argparse.ArgumentParser(description="Importa registro.csv y registros.json al backend de DB_URL")
+    ap.add_argument("--csv", type=Path, default=CSV_PATH)
+    ap.add_argument("--json", type=Path, default=JSON_PATH)
+    args = ap.parse_args()
+    print(json.dumps(importar(crear_registro(CSV_PATH), args.csv, args.json), ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
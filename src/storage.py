@@ -0,0 +1,400 @@
+import base64
+import bisect
+import csv
+import io
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator
+
+logger = logging.getLogger("starlab2")
+
+COLUMNAS = ["Nombre", "Licencia", "Vehiculo", "FechaRegistro"]
+LOTE_LECTURA = 1000  # filas por fetchmany al exportar desde SQLite
+
+def normalizar_licencia(licencia: str) -> str:
+    return str(licencia).strip().upper()
+
+def normalizar_conductor(nombre: str, licencia: str, vehiculo: str, fecha: str | None = None) -> dict:
+    """Aplica el mismo formato con el que se guarda cada conductor."""
+    return {"Nombre": str(nombre).strip().title(), "Licencia": normalizar_licencia(licencia), "Vehiculo": str(vehiculo).strip().title(), "FechaRegistro": fecha or datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+
+def clave_orden(fila: dict) -> tuple:
+    return (fila.get("FechaRegistro") or "", fila.get("Licencia") or "")
+
+def codificar_cursor(fila: dict) -> str:
+    """Cursor opaco (FechaRegistro + Licencia) de la última fila de una página."""
+    return base64.urlsafe_b64encode(json.dumps(list(clave_orden(fila))).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decodificar_cursor(cursor: str) -> tuple:
+    try:
+        fecha, licencia = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return (str(fecha), str(licencia))
+    except Exception:
+        raise ValueError("Cursor inválido")
+
+def _texto_busqueda(fila: dict) -> str:
+    return f"{fila.get('Nombre') or ''}\n{fila.get('Licencia') or ''}\n{fila.get('Vehiculo') or ''}".lower()
+
+class Registro:
+    """Interfaz común de los backends del registro de conductores."""
+
+    def ensure(self):
+        pass
+
+    def cargar(self):
+        pass
+
+    def existe(self, licencia: str) -> bool:
+        raise NotImplementedError
+
+    def total(self) -> int:
+        raise NotImplementedError
+
+    def existentes(self, licencias: Iterable[str]) -> set[str]:
+        """Subconjunto de licencias (ya normalizadas) que están registradas."""
+        return {lic for lic in licencias if self.existe(lic)}
+
+    def insertar(self, filas: Iterable[dict]) -> list[dict]:
+        """Guarda filas ya normalizadas y devuelve las insertadas (omite licencias repetidas)."""
+        raise NotImplementedError
+
+    def iterar(self, desde: str | None = None) -> Iterator[dict]:
+        """Todas las filas; con `desde`, solo las de FechaRegistro >= desde en orden de fecha."""
+        raise NotImplementedError
+
+    def version(self) -> str:
+        """Identificador que cambia con cada escritura (base del ETag de /exportar)."""
+        raise NotImplementedError
+
+    def ultima_modificacion(self) -> datetime:
+        raise NotImplementedError
+
+    def listar(self) -> list[dict]:
+        return list(self.iterar())
+
+    def pagina(self, limit: int = 50, cursor: str | None = None, q: str | None = None) -> dict:
+        """Una página de conductores, de más reciente a más antiguo (paginación por clave).
+
+        Devuelve {"conductores", "total" (coincidencias), "siguiente" (cursor o None)}.
+        """
+        raise NotImplementedError
+
+    def agregar(self, nombre: str, licencia: str, vehiculo: str):
+        """Registra un conductor. Devuelve None si la licencia ya existe."""
+        insertados = self.insertar([normalizar_conductor(nombre, licencia, vehiculo)])
+        return insertados[0] if insertados else None
+
+    def csv_en_disco(self) -> tuple[Path, int, int] | None:
+        """(fichero, inicio, fin) si exportar_csv() son exactamente esos bytes de un fichero; si no, None."""
+        return None
+
+    def exportar_csv(self) -> Iterator[str]:
+        buf = io.StringIO()
+        w = csv.writer(buf, lineterminator="\n")
+        w.writerow(COLUMNAS)
+        for n, fila in enumerate(self.iterar(), 1):
+            w.writerow([fila[c] for c in COLUMNAS])
+            if n % 1000 == 0:
+                yield buf.getvalue()
+                buf.seek(0); buf.truncate()
+        yield buf.getvalue()
+
+class RegistroCSV(Registro):
+    """Registro append-only sobre el CSV.
+
+    Mantiene en memoria una instantánea de las filas y el índice de licencias
+    normalizadas; se actualiza en cada escritura y se recarga si el fichero
+    cambia (mtime/tamaño) fuera de este proceso.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.RLock()
+        self._filas: list[dict] = []
+        self._licencias: set[str] = set()
+        self._claves: list[tuple] = []
+        self._ordenadas: list[dict] = []
+        self._firma = None
+
+    def ensure(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if not self.path.exists():
+            with open(self.path, "w", encoding="utf-8", newline="") as f:
+                csv.writer(f, lineterminator="\n").writerow(COLUMNAS)
+            logger.info(f"CSV creado: {self.path}")
+
+    def _firma_actual(self):
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def cargar(self):
+        """Lee el CSV completo y reconstruye instantánea e índice."""
+        with self._lock:
+            self.ensure()
+            firma = self._firma_actual()
+            with open(self.path, "r", encoding="utf-8-sig", newline="") as f:
+                filas = list(csv.DictReader(f))
+            self._filas, self._firma = filas, firma
+            self._licencias = {normalizar_licencia(row.get("Licencia") or "") for row in filas}
+            self._ordenadas = sorted(filas, key=clave_orden)
+            self._claves = [clave_orden(row) for row in self._ordenadas]
+        logger.info(f"Índice de licencias cargado: {len(filas)} registros")
+
+    def _snapshot(self) -> list[dict]:
+        firma = self._firma_actual()
+        if self._firma is None or firma != self._firma:
+            if self._firma is not None:
+                logger.info(f"CSV modificado fuera del proceso, recargando: {self.path}")
+            self.cargar()
+        return self._filas
+
+    def existe(self, licencia: str) -> bool:
+        self._snapshot()
+        return normalizar_licencia(licencia) in self._licencias
+
+    def total(self) -> int:
+        return len(self._snapshot())
+
+    def existentes(self, licencias: Iterable[str]) -> set[str]:
+        self._snapshot()
+        return self._licencias.intersection(licencias)
+
+    def insertar(self, filas: Iterable[dict]) -> list[dict]:
+        with self._lock:
+            self._snapshot()
+            nuevos, vistas = [], set()
+            for fila in filas:
+                if fila["Licencia"] in self._licencias or fila["Licencia"] in vistas:
+                    continue
+                vistas.add(fila["Licencia"])
+                nuevos.append(fila)
+            if not nuevos:
+                return []
+            with open(self.path, "a", encoding="utf-8", newline="") as f:
+                # Si el fichero no termina en salto de línea, no pegamos la fila a la anterior
+                if not self._termina_en_salto():
+                    f.write("\n")
+                csv.writer(f, lineterminator="\n").writerows([fila[c] for c in COLUMNAS] for fila in nuevos)
+                f.flush()
+                os.fsync(f.fileno())
+            self._filas.extend(nuevos)
+            self._licencias |= vistas
+            for fila in nuevos:
+                # Las altas llegan casi siempre en orden de fecha: el insort cae al final
+                i = bisect.bisect_right(self._claves, clave_orden(fila))
+                self._claves.insert(i, clave_orden(fila))
+                self._ordenadas.insert(i, fila)
+            self._firma = self._firma_actual()
+        return nuevos
+
+    def _termina_en_salto(self) -> bool:
+        with open(self.path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) in (b"\n", b"\r")
+
+    def iterar(self, desde: str | None = None) -> Iterator[dict]:
+        if desde is None:
+            # Copia superficial: una exportación en curso no ve las altas posteriores
+            return iter(self._snapshot()[:])
+        with self._lock:
+            self._snapshot()
+            return iter(self._ordenadas[bisect.bisect_left(self._claves, (desde,)):])
+
+    def version(self) -> str:
+        self._snapshot()
+        return "{}-{}".format(*self._firma)
+
+    def ultima_modificacion(self) -> datetime:
+        self._snapshot()
+        return datetime.fromtimestamp(self._firma[0] / 1e9)
+
+    def listar(self) -> list[dict]:
+        """Instantánea compartida en memoria: no modificar la lista devuelta."""
+        return self._snapshot()
+
+    def pagina(self, limit: int = 50, cursor: str | None = None, q: str | None = None) -> dict:
+        with self._lock:
+            self._snapshot()
+            claves, ordenadas = self._claves, self._ordenadas
+            inicio = bisect.bisect_left(claves, decodificar_cursor(cursor)) if cursor else len(claves)
+            q = (q or "").strip().lower()
+            if not q:
+                conductores = ordenadas[max(0, inicio - limit):inicio][::-1]
+                total = len(ordenadas)
+            else:
+                conductores = []
+                for i in range(inicio - 1, -1, -1):
+                    if q in _texto_busqueda(ordenadas[i]):
+                        conductores.append(ordenadas[i])
+                        if len(conductores) == limit:
+                            break
+                total = sum(1 for fila in ordenadas if q in _texto_busqueda(fila))
+        siguiente = codificar_cursor(conductores[-1]) if len(conductores) == limit else None
+        return {"conductores": conductores, "total": total, "siguiente": siguiente}
+
+    def csv_en_disco(self) -> tuple[Path, int, int] | None:
+        # Append-only: los bytes hasta el tamaño de la instantánea (la del ETag) ya no cambian
+        self._snapshot()
+        with open(self.path, "rb") as f:
+            inicio = 3 if f.read(3) == b"\xef\xbb\xbf" else 0  # exportar_csv quita el BOM
+        return self.path, inicio, self._firma[1]
+
+    def exportar_csv(self) -> Iterator[str]:
+        self.ensure()
+        with open(self.path, "r", encoding="utf-8-sig", newline="") as f:
+            while chunk := f.read(64 * 1024):
+                yield chunk
+
+class RegistroSQLite(Registro):
+    """Registro en SQLite (WAL) con índice único por licencia normalizada."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._total = None
+        self._version = None
+
+    def ensure(self):
+        if self._conn is not None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        # FULL: en WAL, NORMAL no hace fsync al confirmar; el lote agrupado es lo que reparte ese fsync
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS conductores (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                Nombre TEXT NOT NULL,
+                Licencia TEXT NOT NULL,
+                Vehiculo TEXT NOT NULL,
+                FechaRegistro TEXT NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS ux_conductores_licencia ON conductores(Licencia);
+            DROP INDEX IF EXISTS ix_conductores_fecha;
+            CREATE INDEX IF NOT EXISTS ix_conductores_fecha_licencia ON conductores(FechaRegistro, Licencia);
+            CREATE INDEX IF NOT EXISTS ix_conductores_vehiculo ON conductores(Vehiculo);
+        """)
+        self._conn = conn
+        logger.info(f"SQLite abierto: {self.path}")
+
+    def cargar(self):
+        self.ensure()
+
+    def _consulta(self, sql: str, params=()):
+        self.ensure()
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def existe(self, licencia: str) -> bool:
+        return bool(self._consulta("SELECT 1 FROM conductores WHERE Licencia = ?", (normalizar_licencia(licencia),)))
+
+    def total(self) -> int:
+        # data_version solo cambia si otra conexión confirma cambios; los propios se suman en insertar()
+        version = self._consulta("PRAGMA data_version")[0][0]
+        if self._total is None or version != self._version:
+            self._total = self._consulta("SELECT COUNT(*) FROM conductores")[0][0]
+            self._version = version
+        return self._total
+
+    def existentes(self, licencias: Iterable[str]) -> set[str]:
+        licencias = list(dict.fromkeys(licencias))
+        encontradas = set()
+        for i in range(0, len(licencias), 500):
+            parte = licencias[i:i + 500]
+            filas = self._consulta(f"SELECT Licencia FROM conductores WHERE Licencia IN ({','.join('?' * len(parte))})", parte)
+            encontradas.update(row[0] for row in filas)
+        return encontradas
+
+    def insertar(self, filas: Iterable[dict]) -> list[dict]:
+        self.ensure()
+        nuevos = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for fila in filas:
+                    cur = self._conn.execute(
+                        "INSERT OR IGNORE INTO conductores (Nombre, Licencia, Vehiculo, FechaRegistro) VALUES (?, ?, ?, ?)",
+                        [fila[c] for c in COLUMNAS])
+                    if cur.rowcount:
+                        nuevos.append(fila)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            if self._total is not None:
+                self._total += len(nuevos)
+        return nuevos
+
+    def iterar(self, desde: str | None = None) -> Iterator[dict]:
+        # Conexión de lectura propia y lotes de fetchmany: memoria constante sin bloquear a los escritores.
+        # La transacción de lectura (WAL) fija una instantánea: no se ven altas posteriores.
+        self.ensure()
+        conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        try:
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute("BEGIN")
+            if desde is None:
+                cur = conn.execute("SELECT Nombre, Licencia, Vehiculo, FechaRegistro FROM conductores ORDER BY id")
+            else:
+                cur = conn.execute("SELECT Nombre, Licencia, Vehiculo, FechaRegistro FROM conductores WHERE FechaRegistro >= ? ORDER BY FechaRegistro, Licencia", (desde,))
+            while filas := cur.fetchmany(LOTE_LECTURA):
+                for nombre, licencia, vehiculo, fecha in filas:
+                    yield {"Nombre": nombre, "Licencia": licencia, "Vehiculo": vehiculo, "FechaRegistro": fecha}
+        finally:
+            conn.close()
+
+    def version(self) -> str:
+        return f"{self.total()}-{self._consulta('SELECT COALESCE(MAX(id), 0) FROM conductores')[0][0]}"
+
+    def ultima_modificacion(self) -> datetime:
+        self.ensure()
+        wal = self.path.with_name(self.path.name + "-wal")
+        return datetime.fromtimestamp(max(p.stat().st_mtime for p in (self.path, wal) if p.exists()))
+
+    def pagina(self, limit: int = 50, cursor: str | None = None, q: str | None = None) -> dict:
+        where, params = [], []
+        q = (q or "").strip()
+        if q:
+            patron = "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            where.append("(Nombre LIKE ? ESCAPE '\\' OR Licencia LIKE ? ESCAPE '\\' OR Vehiculo LIKE ? ESCAPE '\\')")
+            params += [patron] * 3
+            total = self._consulta("SELECT COUNT(*) FROM conductores WHERE " + where[0], params)[0][0]
+        else:
+            total = self.total()
+        if cursor:
+            where.append("(FechaRegistro, Licencia) < (?, ?)")
+            params += list(decodificar_cursor(cursor))
+        sql = "SELECT Nombre, Licencia, Vehiculo, FechaRegistro FROM conductores"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY FechaRegistro DESC, Licencia DESC LIMIT ?"
+        conductores = [dict(row) for row in self._consulta(sql, params + [limit])]
+        siguiente = codificar_cursor(conductores[-1]) if len(conductores) == limit else None
+        return {"conductores": conductores, "total": total, "siguiente": siguiente}
+
+def crear_registro(csv_path: Path, db_url: str | None = None) -> Registro:
+    """Elige el backend según DB_URL: sqlite:///ruta.db usa SQLite, vacío usa el CSV."""
+    db_url = db_url if db_url is not None else os.getenv("DB_URL", "")
+    if db_url.startswith("sqlite:///"):
+        path = Path(db_url[len("sqlite:///"):])
+        if not path.is_absolute():
+            path = Path(csv_path).resolve().parent.parent / path
+        return RegistroSQLite(path)
+    if db_url:
+        logger.warning(f"DB_URL no soportada ({db_url}), se usa el CSV")
+    return RegistroCSV(csv_path)
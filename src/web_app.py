@@ -1,10 +1,17 @@
-﻿from fastapi import FastAPI, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse
+﻿from fastapi import FastAPI, Request, Form, HTTPException, Query, UploadFile, File
+from fastapi.responses import HTMLResponse, StreamingResponse, Response, JSONResponse
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 from pathlib import Path
-import pandas as pd
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import hashlib
+import os
 import logging
+from .storage import crear_registro, COLUMNAS
+from .carga_masiva import importar_masivo
+from .escritor import EscritorRegistro
+from .exportacion import FORMATOS, GENERADORES, formato_disponible, parsear_rango, servir_fichero, volcar_temporal
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger("starlab2")
@@ -16,24 +23,35 @@ TEMPLATES_DIR = BASE_DIR / "templates"
 DATA_DIR = BASE_DIR.parent / "data"
 CSV_PATH = DATA_DIR / "registro.csv"
 templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
+registro = crear_registro(CSV_PATH)
+escritor = EscritorRegistro(registro)
 
 def ensure_csv():
-    DATA_DIR.mkdir(parents=True, exist_ok=True)
-    if not CSV_PATH.exists():
-        pd.DataFrame(columns=["Nombre","Licencia","Vehiculo","FechaRegistro"]).to_csv(CSV_PATH,index=False,encoding="utf-8")
-        logger.info(f"CSV creado: {CSV_PATH}")
+    registro.ensure()
 
 @app.on_event("startup")
 async def startup_event():
-    ensure_csv()
+    registro.cargar()
+    escritor.iniciar()
     logger.info("Aplicación iniciada")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await escritor.detener()
+
+def render_registro(request: Request, mensaje=None, mensaje_tipo=None, limit: int = 50, cursor: str | None = None, q: str | None = None):
+    try:
+        pagina = registro.pagina(limit=limit, cursor=cursor, q=q)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return templates.TemplateResponse("registro.html", {"request": request, "conductores": pagina["conductores"], "mensaje": mensaje, "mensaje_tipo": mensaje_tipo, "total": registro.total(), "encontrados": pagina["total"], "siguiente": pagina["siguiente"], "limit": limit, "q": q or ""})
+
 @app.get("/", response_class=HTMLResponse)
-async def home(request: Request):
+async def home(request: Request, limit: int = Query(50, ge=1, le=500), cursor: str | None = None, q: str | None = Query(None, max_length=100)):
     try:
-        ensure_csv()
-        df = pd.read_csv(CSV_PATH, encoding="utf-8")
-        return templates.TemplateResponse("registro.html", {"request": request, "conductores": df.to_dict("records"), "mensaje": None, "total": len(df)})
+        return render_registro(request, limit=limit, cursor=cursor, q=q)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error en home: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -41,30 +59,121 @@ async def home(request: Request):
 @app.post("/registrar", response_class=HTMLResponse)
 async def registrar(request: Request, nombre: str = Form(..., min_length=2, max_length=100), licencia: str = Form(..., min_length=5, max_length=20), vehiculo: str = Form(..., min_length=2, max_length=50)):
     try:
-        ensure_csv()
-        df = pd.read_csv(CSV_PATH, encoding="utf-8")
-        if licencia in df["Licencia"].values:
-            return templates.TemplateResponse("registro.html", {"request": request, "conductores": df.to_dict("records"), "mensaje": f"⚠️ La licencia {licencia} ya está registrada", "mensaje_tipo": "warning", "total": len(df)})
-        nuevo = {"Nombre": nombre.strip().title(), "Licencia": licencia.strip().upper(), "Vehiculo": vehiculo.strip().title(), "FechaRegistro": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-        df = pd.concat([df, pd.DataFrame([nuevo])], ignore_index=True)
-        df.to_csv(CSV_PATH, index=False, encoding="utf-8")
-        logger.info(f"Conductor registrado: {nombre} - {licencia}")
-        return templates.TemplateResponse("registro.html", {"request": request, "conductores": df.to_dict("records"), "mensaje": f"✅ Conductor {nombre} registrado correctamente", "mensaje_tipo": "success", "total": len(df)})
+        nuevo = await escritor.agregar(nombre, licencia, vehiculo)
+        if nuevo is None:
+            return render_registro(request, f"⚠️ La licencia {licencia} ya está registrada", "warning")
+        logger.info(f"Conductor registrado: {nuevo['Nombre']} - {nuevo['Licencia']}")
+        return render_registro(request, f"✅ Conductor {nombre} registrado correctamente", "success")
     except Exception as e:
         logger.error(f"Error al registrar: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/conductores")
+async def api_conductores(limit: int = Query(50, ge=1, le=500), cursor: str | None = None, q: str | None = Query(None, max_length=100)):
+    try:
+        return registro.pagina(limit=limit, cursor=cursor, q=q)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def normalizar_desde(since: str) -> str:
+    """Convierte `since` (ISO 8601) al formato de FechaRegistro para comparar como texto."""
+    try:
+        dt = datetime.fromisoformat(since.strip().replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"since inválido: {since}")
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+def no_modificado(request: Request, etag: str, modificado: datetime) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        etiquetas = {e.strip().removeprefix("W/") for e in if_none_match.split(",")}
+        return "*" in etiquetas or etag.removeprefix("W/") in etiquetas
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return modificado.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+@app.post("/api/conductores/bulk")
+async def api_carga_masiva(archivo: UploadFile = File(...), formato: str | None = Query(None)):
+    """Alta masiva desde un CSV o NDJSON con columnas Nombre, Licencia y Vehiculo."""
+    if formato is None:
+        nombre = (archivo.filename or "").lower()
+        formato = "ndjson" if nombre.endswith((".ndjson", ".jsonl")) or "ndjson" in (archivo.content_type or "") else "csv"
+    try:
+        # JSONResponse directo: el informe ya son tipos nativos y jsonable_encoder es lento con 50k filas
+        return JSONResponse(await run_in_threadpool(importar_masivo, archivo.file, formato.lower(), registro))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error en carga masiva: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/exportar")
-async def exportar():
+async def exportar(request: Request, formato: str = Query("csv"), columnas: str | None = None, since: str | None = None):
     try:
-        ensure_csv()
-        if not CSV_PATH.exists():
-            raise HTTPException(status_code=404, detail="No hay datos para exportar")
-        return FileResponse(path=CSV_PATH, media_type="text/csv", filename=f"conductores_{datetime.now().strftime('%Y%m%d')}.csv")
+        formato = formato.lower()
+        if formato not in FORMATOS:
+            raise HTTPException(status_code=400, detail=f"Formato no soportado: {formato} (usa {', '.join(FORMATOS)})")
+        if not formato_disponible(formato):
+            raise HTTPException(status_code=501, detail=f"Formato {formato} no disponible: falta {'XlsxWriter' if formato == 'xlsx' else 'pyarrow'}")
+        cols = [c.strip() for c in columnas.split(",") if c.strip()] if columnas else list(COLUMNAS)
+        if not cols or any(c not in COLUMNAS for c in cols):
+            raise HTTPException(status_code=400, detail=f"Columnas válidas: {', '.join(COLUMNAS)}")
+        desde = normalizar_desde(since) if since else None
+        media_type, extension, admite_rango = FORMATOS[formato]
+
+        clave = hashlib.sha1(f"{registro.version()}|{formato}|{','.join(cols)}|{desde or ''}".encode("utf-8")).hexdigest()[:32]
+        etag = f'"{clave}"' if admite_rango else f'W/"{clave}"'
+        modificado = registro.ultima_modificacion().astimezone(timezone.utc)
+        headers = {"ETag": etag, "Last-Modified": format_datetime(modificado, usegmt=True), "Cache-Control": "no-cache"}
+        if admite_rango:
+            headers["Accept-Ranges"] = "bytes"
+        if no_modificado(request, etag, modificado):
+            return Response(status_code=304, headers=headers)
+
+        def contenido():
+            if formato == "csv" and cols == COLUMNAS and desde is None:
+                return (chunk.encode("utf-8") for chunk in registro.exportar_csv())
+            return GENERADORES[formato](registro.iterar(desde), cols)
+
+        rango = parsear_rango(request.headers.get("range")) if admite_rango else None
+        if rango and request.headers.get("if-range", etag) != etag:
+            rango = None
+        if rango:
+            # El CSV completo se corta del fichero; el resto se genera una sola vez en un temporal,
+            # así el tamaño y los bytes servidos salen de la misma instantánea
+            en_disco = registro.csv_en_disco() if formato == "csv" and cols == COLUMNAS and desde is None else None
+            if en_disco:
+                path, base, tam = en_disco
+                total, temporal = tam - base, False
+            else:
+                path, total = await run_in_threadpool(volcar_temporal, contenido())
+                base, temporal = 0, True
+            inicio, fin = rango
+            if inicio >= total:
+                if temporal:
+                    os.unlink(path)
+                return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{total}"})
+            fin = total - 1 if fin is None else min(fin, total - 1)
+            headers.update({"Content-Range": f"bytes {inicio}-{fin}/{total}", "Content-Length": str(fin - inicio + 1)})
+            return StreamingResponse(servir_fichero(path, base + inicio, base + fin, temporal), status_code=206,
+                                     media_type=media_type, headers=headers)
+
+        sufijo = f"_desde_{desde[:10].replace('-', '')}" if desde else ""
+        filename = f"conductores_{datetime.now().strftime('%Y%m%d')}{sufijo}.{extension}"
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return StreamingResponse(contenido(), media_type=media_type, headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error al exportar: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/health")
 async def health():
-    return {"status":"healthy","timestamp":datetime.now().isoformat(),"registros":len(pd.read_csv(CSV_PATH,encoding="utf-8"))}
+    return {"status":"healthy","timestamp":datetime.now().isoformat(),"registros":registro.total()}
@@ -1,15 +1,28 @@
 ﻿import os
 import json
+import gzip
+import hashlib
+import logging
+import threading
 from datetime import datetime
 from pathlib import Path
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, Request, HTTPException, Query
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 
+try:
+    import brotli  # opcional: variante br de la página principal
+except ImportError:
+    brotli = None
+
 REGISTRO_PATH = r"""C:\\Users\\Camilo C\\Documents\\starlab2\\Starlab2Py\\PSI_Backup\\src\\templates\\registro.html"""
 DATA_DIR = Path.home() / ".starlabpw" / "data"
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 REGISTROS_FILE = DATA_DIR / "registros.json"
+REGISTROS_LOG = DATA_DIR / "registros.log.jsonl"
+COMPACTAR_CADA = int(os.getenv("STARLAB_COMPACTAR_CADA", "1000"))
+
+logger = logging.getLogger("starlab_autoserve")
 
 app = FastAPI(
     title="Starlab AutoServe",
@@ -25,23 +38,106 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class AlmacenRegistros:
+    """Registros en memoria respaldados por una instantánea JSON y un log JSONL append-only.
+
+    Cada alta se añade al log (una línea, fsync) con un ID monotónico asignado bajo
+    lock. Cada `compactar_cada` altas se reescribe la instantánea y se vacía el log.
+    Al arrancar se carga la instantánea y se reaplican las entradas del log con
+    ID mayor que el último de la instantánea.
+    """
+
+    def __init__(self, snapshot: Path, log: Path, compactar_cada: int = COMPACTAR_CADA):
+        self.snapshot = snapshot
+        self.log = log
+        self.compactar_cada = compactar_cada
+        self._lock = threading.Lock()
+        self._registros = []
+        self._ultimo_id = 0
+        self._en_log = 0
+        self._cargar()
+
+    def _cargar(self):
+        registros = []
+        if self.snapshot.exists():
+            try:
+                with open(self.snapshot, "r", encoding="utf-8") as f:
+                    registros = json.load(f)
+            except Exception as e:
+                # Sin la instantánea, compactar el log la sobrescribiría solo con la cola: no se arranca
+                logger.error(f"Instantánea ilegible ({self.snapshot}): {e}")
+                raise RuntimeError(f"No se puede leer {self.snapshot}; restáurala o apártala antes de arrancar") from e
+        ultimo_snapshot = max((r.get("id") or 0 for r in registros), default=0)
+        reaplicados = 0
+        if self.log.exists():
+            with open(self.log, "r", encoding="utf-8") as f:
+                for linea in f:
+                    try:
+                        r = json.loads(linea)
+                    except json.JSONDecodeError:
+                        # Línea a medio escribir por una caída: se descarta
+                        logger.warning("Entrada incompleta en el log de registros, se ignora")
+                        continue
+                    if (r.get("id") or 0) > ultimo_snapshot:
+                        registros.append(r)
+                        reaplicados += 1
+        self._registros = registros
+        self._ultimo_id = max((r.get("id") or 0 for r in registros), default=0)
+        self._en_log = reaplicados
+        # Compactar también vacía el log, incluida una posible línea cortada al final
+        if self.log.exists() and self.log.stat().st_size:
+            self.compactar()
+
+    def todos(self):
+        return self._registros
+
+    def iterar(self, inicio: int = 0):
+        """(posición, registro) desde `inicio` hasta el final actual; las altas posteriores no entran."""
+        fin = len(self._registros)
+        for pos in range(inicio, fin):
+            yield pos, self._registros[pos]
+
+    def agregar(self, data):
+        with self._lock:
+            self._ultimo_id += 1
+            data["timestamp"] = datetime.now().isoformat()
+            data["id"] = self._ultimo_id
+            with open(self.log, "a", encoding="utf-8") as f:
+                f.write(json.dumps(data, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._registros.append(data)
+            self._en_log += 1
+            if self._en_log >= self.compactar_cada:
+                self._compactar()
+        return data
+
+    def compactar(self):
+        with self._lock:
+            self._compactar()
+
+    def _compactar(self):
+        tmp = self.snapshot.with_suffix(".json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._registros, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot)
+        # Si caemos antes de vaciar el log, el arranque ignora los IDs ya incluidos
+        open(self.log, "w").close()
+        self._en_log = 0
+
+almacen = AlmacenRegistros(REGISTROS_FILE, REGISTROS_LOG)
+
 def load_registros():
-    if REGISTROS_FILE.exists():
-        try:
-            with open(REGISTROS_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except:
-            return []
-    return []
+    return almacen.todos()
 
 def save_registro(data):
-    registros = load_registros()
-    data["timestamp"] = datetime.now().isoformat()
-    data["id"] = len(registros) + 1
-    registros.append(data)
-    with open(REGISTROS_FILE, "w", encoding="utf-8") as f:
-        json.dump(registros, f, indent=2, ensure_ascii=False)
-    return data
+    return almacen.agregar(data)
+
+@app.on_event("shutdown")
+def compactar_al_salir():
+    almacen.compactar()
 
 @app.get("/health")
 def health():
@@ -51,8 +147,72 @@ def health():
         "service": "Starlab AutoServe v2.0"
     }
 
+class PaginaCacheada:
+    """Fichero HTML en memoria con variantes gzip/brotli precomprimidas y ETag fuerte.
+
+    Se recarga cuando cambian el mtime o el tamaño del fichero.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._firma = None
+        self._variantes = {}
+        self._lock = threading.Lock()
+
+    def _cargar(self, firma):
+        with open(self.path, "rb") as f:
+            cuerpo = f.read()
+        cuerpo.decode("utf-8")  # falla aquí, no en el navegador, si el fichero no es UTF-8
+        etag = hashlib.sha256(cuerpo).hexdigest()[:32]
+        variantes = {None: (cuerpo, f'"{etag}"'), "gzip": (gzip.compress(cuerpo, 9, mtime=0), f'"{etag}-gz"')}
+        if brotli is not None:
+            variantes["br"] = (brotli.compress(cuerpo, quality=11), f'"{etag}-br"')
+        self._variantes, self._firma = variantes, firma
+
+    def variantes(self):
+        st = os.stat(self.path)
+        firma = (st.st_mtime_ns, st.st_size)
+        if firma != self._firma:
+            with self._lock:
+                if firma != self._firma:
+                    self._cargar(firma)
+        return self._variantes
+
+    def respuesta(self, request: Request) -> Response:
+        variantes = self.variantes()
+        aceptadas = codificaciones_aceptadas(request.headers.get("accept-encoding", ""))
+        codificacion = next((c for c in ("br", "gzip") if aceptadas.get(c, aceptadas.get("*", 0)) > 0 and c in variantes), None)
+        cuerpo, etag = variantes[codificacion]
+        headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+        if codificacion:
+            headers["Content-Encoding"] = codificacion
+        if_none_match = request.headers.get("if-none-match", "")
+        if etag in (e.strip().removeprefix("W/") for e in if_none_match.split(",")):
+            return Response(status_code=304, headers=headers)
+        return Response(cuerpo, media_type="text/html; charset=utf-8", headers=headers)
+
+def codificaciones_aceptadas(cabecera: str) -> dict:
+    """Accept-Encoding -> {codificación: q}; q=0 (o un q inválido) es un rechazo explícito."""
+    aceptadas = {}
+    for parte in cabecera.split(","):
+        nombre, *params = [x.strip() for x in parte.split(";")]
+        if not nombre:
+            continue
+        q = 1.0
+        for param in params:
+            clave, _, valor = param.partition("=")
+            if clave.strip().lower() == "q":
+                try:
+                    q = float(valor)
+                except ValueError:
+                    q = 0.0
+        aceptadas[nombre.lower()] = q
+    return aceptadas
+
+pagina_registro = PaginaCacheada(REGISTRO_PATH)
+
 @app.get("/", response_class=HTMLResponse)
-def home():
+def home(request: Request):
     if not os.path.isfile(REGISTRO_PATH):
         return HTMLResponse(
             "<h1>❌ Error</h1><p>No se encontró registro.html</p>",
@@ -60,8 +220,7 @@ def home():
         )
     
     try:
-        with open(REGISTRO_PATH, "r", encoding="utf-8") as f:
-            return HTMLResponse(f.read())
+        return pagina_registro.respuesta(request)
     except Exception as e:
         return HTMLResponse(
             f"<h1>❌ Error</h1><p>Error leyendo registro.html: {str(e)}</p>",
@@ -185,6 +344,63 @@ async def api_registrar(request: Request):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def filtrar_registros(inicio=0, licencia=None, vehiculo=None, desde=None, hasta=None):
+    """Recorre el almacén en orden de alta aplicando los filtros sin construir listas."""
+    licencia = (licencia or "").strip().upper()
+    vehiculo = (vehiculo or "").strip().lower()
+    for pos, r in almacen.iterar(inicio):
+        if licencia and not str(r.get("licencia") or "").strip().upper().startswith(licencia):
+            continue
+        if vehiculo and str(r.get("vehiculo") or "").strip().lower() != vehiculo:
+            continue
+        ts = r.get("timestamp") or ""
+        if (desde and ts < desde) or (hasta and ts > hasta):
+            continue
+        yield pos, r
+
+def proyectar(r, campos):
+    return {c: r.get(c) for c in campos} if campos else r
+
 @app.get("/api/registros")
-def api_get_registros():
-    return JSONResponse({"ok": True, "registros": load_registros()})
+def api_get_registros(
+    request: Request,
+    limit: int | None = Query(None, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+    cursor: str | None = None,
+    licencia: str | None = None,
+    vehiculo: str | None = None,
+    desde: str | None = None,
+    hasta: str | None = None,
+    campos: str | None = None,
+):
+    """Registros paginados (offset o cursor) y filtrados; con Accept: application/x-ndjson se emiten en streaming."""
+    try:
+        inicio = int(cursor) if cursor else 0
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    if inicio < 0:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    lista_campos = [c.strip() for c in campos.split(",") if c.strip()] if campos else None
+    filas = filtrar_registros(inicio, licencia, vehiculo, desde, hasta)
+    # offset se aplica sobre los resultados filtrados; el cursor salta directamente a la posición
+    for _ in range(offset):
+        if next(filas, None) is None:
+            break
+
+    if "application/x-ndjson" in request.headers.get("accept", ""):
+        def lineas():
+            for n, (_, r) in enumerate(filas, 1):
+                yield json.dumps(proyectar(r, lista_campos), ensure_ascii=False) + "\n"
+                if limit and n >= limit:
+                    break
+        return StreamingResponse(lineas(), media_type="application/x-ndjson")
+
+    limit = limit or 100
+    pagina, ultima = [], None
+    for pos, r in filas:
+        pagina.append(proyectar(r, lista_campos))
+        ultima = pos
+        if len(pagina) == limit:
+            break
+    siguiente = str(ultima + 1) if len(pagina) == limit else None
+    return JSONResponse({"ok": True, "registros": pagina, "siguiente": siguiente})
@@ -0,0 +1,89 @@
+"""Benchmark: detección de tablas (page.extract_tables) frente a parse_text_layer.
+
+Uso: python tools/bench_extraccion.py [--provider vtm] [--folder invoices/vtm]
+Mide páginas/s de ambos caminos sobre las mismas páginas y compara las filas
+normalizadas. Si el provider no tiene layouts en tools/layouts.json, se aprende uno
+en memoria a partir de la primera tabla detectada (igual que layouts_pendientes).
+"""
+import argparse, os, sys, time
+from pathlib import Path
+
+os.environ.setdefault("STARLAB_BASE", str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import pandas as pd
+
+import pipeline_vtm_talixo as pipeline
+
+def table_path(page):
+    dfs = [pd.DataFrame(t) for t in page.extract_tables() or []]
+    return [df for df in dfs if df.shape[1] >= 3 and df.shape[0] >= 2]
+
+def learn_layout(provider: str, pages):
+    for page in pages:
+        for df in table_path(page):
+            try:
+                header, body = pipeline.split_header(df)
+            except pipeline.HeaderlessTable:
+                continue
+            cols = pipeline.guess_columns(header)
+            if cols["fecha"] is None:
+                continue
+            fmt = pipeline.guess_date_format(list(body[cols["fecha"]]))
+            if fmt and all(header):
+                columns = {f: header[i] for f, i in cols.items() if i is not None}
+                pipeline._text_layouts[provider] = [pipeline.TextLayout(header, columns, fmt)]
+                pipeline.LAYOUTS.setdefault(provider, {})[pipeline.layout_signature(header)] = {"header": header, "columns": columns, "date_format": fmt}
+                return True
+    return False
+
+def normalized(dfs, provider):
+    rows = pipeline.normalize_tables(dfs, provider)
+    return pd.concat(rows, ignore_index=True) if rows else pd.DataFrame(columns=pipeline.EMPTY_COLUMNS)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--provider", default="vtm")
+    ap.add_argument("--folder", default=None, help="Por defecto BASE/invoices/<provider>")
+    args = ap.parse_args()
+
+    folder = Path(args.folder) if args.folder else pipeline.BASE / "invoices" / args.provider
+    pdfs = [pipeline.pdfplumber.open(str(p)) for p in sorted(folder.glob("*.pdf"))]
+    pages = [page for pdf in pdfs for page in pdf.pages]
+    if not pages:
+        print(f"Sin PDFs en {folder}")
+        return 1
+    if not pipeline.text_layouts(args.provider) and not learn_layout(args.provider, pages):
+        print("No se encontró ningún layout utilizable")
+        return 1
+    layouts = pipeline.text_layouts(args.provider)
+
+    # Una pasada previa para que ambos caminos partan con los caracteres ya parseados
+    for page in pages:
+        page.chars
+    t = time.perf_counter(); slow = [table_path(page) for page in pages]; t_slow = time.perf_counter() - t
+    t = time.perf_counter()
+    fast = []
+    for pdf in pdfs:
+        previous = {}  # las páginas sin cabecera siguen la tabla de la anterior del mismo PDF
+        fast += [pipeline.parse_text_layer(page, layouts, previous) for page in pdf.pages]
+    t_fast = time.perf_counter() - t
+
+    hits = sum(df is not None for df in fast)
+    # Lo que haría extract_tables_pages: texto donde encaja, tablas en el resto
+    mixed = [[df] if df is not None else s for df, s in zip(fast, slow)]
+    a = normalized([df for dfs in slow for df in dfs], args.provider)
+    b = normalized([df for dfs in mixed for df in dfs], args.provider)
+    identical = a.equals(b)
+    for pdf in pdfs:
+        pdf.close()
+
+    print(f"Páginas: {len(pages)} (capa de texto válida en {hits})")
+    print(f"extract_tables:   {len(pages) / t_slow:8.1f} páginas/s")
+    print(f"parse_text_layer: {len(pages) / t_fast:8.1f} páginas/s")
+    print(f"Aceleración:      {t_slow / t_fast:8.1f}x")
+    print(f"Filas: {len(a)} | resultados idénticos: {'sí' if identical else 'NO'}")
+    return 0 if identical else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
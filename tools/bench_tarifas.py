@@ -0,0 +1,62 @@
+"""Benchmark: apply_tarifa fila a fila (iterrows) frente a TariffEngine por columnas.
+
+Uso: python tools/bench_tarifas.py [--rows 1000000] [--sample 20000]
+El camino antiguo se mide sobre --sample filas y se extrapola; ambos resultados se
+comparan sobre esa muestra.
+"""
+import argparse, os, sys, time
+from pathlib import Path
+
+os.environ.setdefault("STARLAB_BASE", str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import numpy as np
+import pandas as pd
+
+import pipeline_vtm_talixo as pipeline
+
+def synthetic(rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    tipos = np.array(["airport", "hourly", "long_distance", "transfer", "other", "", "desconocido"], dtype=object)
+    df = pd.DataFrame({
+        "tipo": rng.choice(tipos, rows),
+        # km con decimales: con km enteros casi no aparecen casi-empates al redondear
+        "km": rng.integers(0, 40000, rows) / 100,
+        # ~40% sin bruto / comisión para que entren las reglas
+        "bruto": np.where(rng.random(rows) < 0.4, 0.0, rng.integers(1000, 90000, rows) / 100),
+        "comision": np.where(rng.random(rows) < 0.5, 0.0, rng.integers(0, 9000, rows) / 100),
+    })
+    return df
+
+def legacy(df: pd.DataFrame):
+    bs, cs, ns = [], [], []
+    for _, r in df.iterrows():
+        b, c, n = pipeline.apply_tarifa(r.to_dict())
+        bs.append(b); cs.append(c); ns.append(n)
+    return np.array(bs, dtype=float), np.array(cs, dtype=float), np.array(ns, dtype=float)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=1_000_000)
+    ap.add_argument("--sample", type=int, default=20_000)
+    args = ap.parse_args()
+
+    df = synthetic(args.rows)
+    sample = df.head(args.sample)
+
+    t = time.perf_counter(); old = legacy(sample); t_old = time.perf_counter() - t
+    new_sample = pipeline.TARIFF_ENGINE.apply(sample)
+    identical = all(np.array_equal(a, b, equal_nan=True) for a, b in zip(old, new_sample))
+
+    t = time.perf_counter(); pipeline.TARIFF_ENGINE.apply(df); t_new = time.perf_counter() - t
+    t_old_full = t_old * args.rows / len(sample)
+
+    print(f"Filas: {args.rows:,} (muestra iterrows: {len(sample):,})")
+    print(f"iterrows + apply_tarifa: {t_old_full:8.2f} s (extrapolado)")
+    print(f"TariffEngine:            {t_new:8.3f} s")
+    print(f"Aceleración:             {t_old_full / t_new:8.0f}x")
+    print(f"Resultados idénticos en la muestra: {'sí' if identical else 'NO'}")
+    return 0 if identical else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""Comprobación: una tabla de viajes que ocupa varias páginas sale entera.
+
+Uso: python tools/check_multipagina.py [--filas 120]
+Genera con reportlab una factura con una sola tabla repartida en varias páginas (la
+cabecera solo en la primera) más una página de condiciones, y comprueba en serie,
+--stream y --workers (un trozo por página) que salen todas las filas con fecha y
+conductor, que el triage no descarta las páginas de continuación y sí la de condiciones.
+"""
+import argparse, os, random, sys, tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+os.environ.setdefault("STARLAB_BASE", str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import pandas as pd
+
+import pipeline_vtm_talixo as pipeline
+
+def make_invoice(path: Path, rows: int, seed: int = 1):
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import PageBreak, Paragraph, SimpleDocTemplate, Table, TableStyle
+
+    rng = random.Random(seed)
+    data = [["Fecha", "Conductor", "Servicio", "KM", "Total", "Comisión"]]
+    for _ in range(rows):
+        data.append([f"2025-03-{rng.randint(1, 28):02d}", rng.choice(["Juan Perez", "Ana Lopez", "Luis Gomez"]),
+                     rng.choice(["Airport transfer MAD", "City ride", "Hourly hire 3h"]), str(rng.randint(1, 300)),
+                     f"{rng.randint(20, 900)}.{rng.randint(0, 99):02d}", "1.00"])
+    table = Table(data)
+    table.setStyle(TableStyle([("GRID", (0, 0), (-1, -1), 0.5, colors.black)]))
+    terms = Paragraph("Términos y condiciones: " + "lorem ipsum " * 200, getSampleStyleSheet()["Normal"])
+    SimpleDocTemplate(str(path), pagesize=A4).build([table, PageBreak(), terms])
+
+def frame(rows) -> pd.DataFrame:
+    return pd.concat(rows, ignore_index=True) if rows else pd.DataFrame(columns=pipeline.EMPTY_COLUMNS)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--filas", type=int, default=120)
+    ap.add_argument("--provider", default="vtm")
+    args = ap.parse_args()
+    try:
+        import reportlab  # noqa: F401
+    except Exception:
+        print("Hace falta reportlab para generar la factura de prueba")
+        return 2
+
+    with tempfile.TemporaryDirectory(prefix="starlab_multipagina_") as tmp:
+        # Lo que escriba el pipeline (layouts pendientes, cachés) se queda en el temporal, no en data/
+        pipeline.DATA = Path(tmp) / "data"
+        pipeline.LAYOUTS_PENDIENTES = pipeline.DATA / "layouts_pendientes"
+        pipeline.CACHE_DIR = pipeline.DATA / "cache_extraccion"
+        pdf = Path(tmp) / "multipagina.pdf"
+        make_invoice(pdf, args.filas)
+        pages = pipeline.count_pages(pdf)
+
+        stats = Counter()
+        serial = frame(pipeline.normalize_tables(pipeline.extract_tables_pages(pdf, provider=args.provider, stats=stats), args.provider))
+        stream = frame(list(pipeline.stream_pdf(pdf, args.provider, Counter(), [])))
+        per_task, pipeline.PAGES_PER_TASK = pipeline.PAGES_PER_TASK, 1
+        try:
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                parallel = frame(pipeline.collect_parallel([pdf], args.provider, 2, pool=pool)[0])
+        finally:
+            pipeline.PAGES_PER_TASK = per_task
+
+    fallos = []
+    for nombre, df in (("serie", serial), ("stream", stream), ("workers", parallel)):
+        vacias = int(df["fecha"].isna().sum() + df["conductor"].isna().sum())
+        print(f"{nombre:8s}: {len(df)} filas, {vacias} celdas fecha/conductor vacías")
+        if len(df) != args.filas or vacias:
+            fallos.append(nombre)
+    if not serial.equals(parallel) or not serial.equals(stream):
+        fallos.append("modos distintos")
+    print(f"Páginas: {pages} | omitidas: {dict((k, v) for k, v in stats.items() if k.startswith('omitidas'))}")
+    if stats["omitidas_sin_cabecera"] != 1 or stats["omitidas"] != 1:
+        fallos.append("triage")
+    print("OK" if not fallos else f"FALLA: {', '.join(fallos)}")
+    return 1 if fallos else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
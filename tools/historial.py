@@ -0,0 +1,363 @@
+"""Histórico de viajes normalizados en Parquet, particionado por provider y mes.
+
+data/historial/provider=<provider>/mes=<AAAA-MM>/part-*.parquet
+
+Cada viaje pertenece a una factura (el nombre del PDF en la carpeta del provider) y
+lleva `viaje_id`, un hash de (provider, factura, nº de fila en la factura): no depende
+de tarifas ni de importes. Guardar una factura ya guardada con las mismas filas no hace
+nada; si sus filas cambian (otras tarifas, otro extractor, un PDF reemplazado) se
+retiran las anteriores y se escriben las nuevas. retirar_factura() quita una factura
+borrada. conductor, tipo y factura se guardan con codificación de diccionario.
+
+_facturas/<provider>.json guarda, por factura, la huella de sus filas y sus meses.
+_rollups/conductor_{dia,semana,mes}.parquet tienen los totales por provider × factura ×
+conductor × periodo (viajes, bruto, comisión, neto, km); se actualizan solo con las
+facturas que cambian, y sumarlos para un conjunto de facturas cuesta O(filas del
+rollup), no O(viajes).
+
+Consulta: python tools/historial.py --conductor "Ana Lopez" --meses 6 [--provider vtm]
+          python tools/historial.py --rollup mes [--conductor ...] [--reconstruir]
+"""
+import argparse, datetime, hashlib, json, os, sys, threading, uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except Exception:
+    pa = None
+
+KEY_COLUMNS = ["provider", "factura", "fila"]
+COLUMNS = ["viaje_id", "factura", "fila", "fecha", "conductor", "ruta_servicio", "tipo", "km", "bruto", "comision", "neto"]
+SIN_FECHA = "sin_fecha"
+MAX_PARTES = 20  # con más ficheros, la partición se compacta en uno
+FACTURAS_DIR = "_facturas"  # pyarrow.dataset ignora las rutas que empiezan por "_"
+ROLLUP_DIR = "_rollups"
+ROLLUP_KEYS = ["provider", "factura", "conductor", "periodo"]
+ROLLUP_MEDIDAS = ["viajes", "bruto", "comision", "neto", "km"]
+PERIODOS = ("dia", "semana", "mes")
+_rollup_lock = threading.Lock()  # los providers guardan a la vez desde hilos distintos
+
+def disponible() -> bool:
+    return pa is not None
+
+def _schema():
+    return pa.schema([
+        ("viaje_id", pa.uint64()),
+        ("factura", pa.dictionary(pa.int32(), pa.string())),
+        ("fila", pa.int32()),
+        ("fecha", pa.timestamp("us")),
+        ("conductor", pa.dictionary(pa.int32(), pa.string())),
+        ("ruta_servicio", pa.string()),
+        ("tipo", pa.dictionary(pa.int32(), pa.string())),
+        ("km", pa.float64()),
+        ("bruto", pa.float64()),
+        ("comision", pa.float64()),
+        ("neto", pa.float64()),
+    ])
+
+def _partitioning():
+    return ds.partitioning(pa.schema([("provider", pa.string()), ("mes", pa.string())]), flavor="hive")
+
+def viaje_ids(df: pd.DataFrame) -> np.ndarray:
+    """Clave de viaje: hash de (provider, factura, fila)."""
+    claves = df[KEY_COLUMNS].astype(str)
+    return pd.util.hash_pandas_object(claves, index=False).to_numpy(dtype=np.uint64)
+
+def _meses(fecha: pd.Series) -> pd.Series:
+    return fecha.dt.strftime("%Y-%m").fillna(SIN_FECHA)
+
+def _preparar(filas: pd.DataFrame, provider: str, factura: str) -> pd.DataFrame:
+    filas = filas.copy()
+    filas["provider"] = provider
+    filas["factura"] = factura
+    filas["fila"] = np.arange(len(filas), dtype=np.int32)
+    filas["fecha"] = pd.to_datetime(filas["fecha"], errors="coerce")
+    filas["viaje_id"] = viaje_ids(filas)
+    return filas
+
+def _huella(filas: pd.DataFrame) -> str:
+    """Huella del contenido de una factura, estable entre ejecuciones (texto, no dtypes)."""
+    texto = filas[COLUMNS[3:]].astype(str)
+    texto["fecha"] = filas["fecha"].dt.strftime("%Y-%m-%d %H:%M:%S").fillna("")
+    return hashlib.sha256(pd.util.hash_pandas_object(texto, index=False).to_numpy().tobytes()).hexdigest()
+
+def _indice_path(root: Path, provider: str) -> Path:
+    return root / FACTURAS_DIR / f"{provider}.json"
+
+def _indice(root: Path, provider: str) -> dict:
+    try:
+        return json.loads(_indice_path(root, provider).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {}
+
+def _guardar_indice(root: Path, provider: str, indice: dict):
+    path = _indice_path(root, provider)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_text(json.dumps(indice, ensure_ascii=False, indent=1), encoding="utf-8")
+    os.replace(tmp, path)
+
+def _partes(folder: Path):
+    return sorted(folder.glob("part-*.parquet"))
+
+def _hay_historial(root: Path) -> bool:
+    return any(root.glob("provider=*/mes=*/part-*.parquet"))
+
+def _escribir(folder: Path, datos):
+    folder.mkdir(parents=True, exist_ok=True)
+    table = datos if isinstance(datos, pa.Table) else pa.Table.from_pandas(datos[COLUMNS], preserve_index=False)
+    table = table.select(COLUMNS).cast(_schema())
+    nombre = f"part-{datetime.datetime.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}.parquet"
+    # Los ficheros que empiezan por "." no los ve pyarrow.dataset hasta el os.replace
+    tmp = folder / f".{nombre}.tmp"
+    pq.write_table(table, tmp)
+    os.replace(tmp, folder / nombre)
+
+def compactar(folder: Path):
+    """Reúne las partes de una partición en un solo fichero."""
+    partes = _partes(folder)
+    if len(partes) < 2:
+        return
+    _escribir(folder, pq.read_table(partes, schema=_schema()))
+    for parte in partes:
+        parte.unlink()
+
+def _quitar_facturas(folder: Path, facturas) -> int:
+    """Reescribe sin las filas de `facturas` las partes de la partición que las contienen."""
+    valores = pa.array(sorted(facturas), pa.string())
+    quitadas = 0
+    for parte in _partes(folder):
+        columna = pq.read_table(parte, columns=["factura"]).column("factura").cast(pa.string())
+        mask = pc.is_in(columna, value_set=valores)
+        n = pc.sum(mask).as_py() or 0
+        if not n:
+            continue
+        resto = pq.read_table(parte, schema=_schema()).filter(pc.invert(mask))
+        if resto.num_rows:
+            _escribir(folder, resto)
+        parte.unlink()
+        quitadas += n
+    return quitadas
+
+def guardar(df: pd.DataFrame, provider: str, root: Path) -> dict:
+    """Guarda los viajes (ya enriquecidos) de las facturas de `df` (columna `factura`).
+
+    Una factura con la misma huella que la guardada se deja como está; si cambió, sus
+    filas anteriores se retiran del histórico y de los rollups antes de escribir las
+    nuevas. Solo se leen las particiones (provider, mes) de las facturas que cambian.
+    Devuelve {"facturas", "sin_cambios", "nuevos", "retirados"} (las dos últimas en viajes).
+    """
+    res = {"facturas": 0, "sin_cambios": 0, "nuevos": 0, "retirados": 0}
+    if df.empty:
+        return res
+    indice = _indice(root, provider)
+    cambiadas = {}
+    for factura, filas in df.groupby("factura", sort=False):
+        res["facturas"] += 1
+        filas = _preparar(filas, provider, str(factura))
+        huella = _huella(filas)
+        previa = indice.get(factura)
+        if previa and previa["huella"] == huella:
+            res["sin_cambios"] += len(filas)
+            continue
+        cambiadas[factura] = (filas, huella, previa["meses"] if previa else [])
+    if not cambiadas:
+        return res
+
+    nuevas = pd.concat([filas for filas, _, _ in cambiadas.values()], ignore_index=True)
+    meses = _meses(nuevas["fecha"])
+    afectados = set(meses) | {m for _, _, previos in cambiadas.values() for m in previos}
+    base = root / f"provider={provider}"
+    for mes in sorted(afectados):
+        # También limpia restos de una escritura anterior interrumpida antes del índice
+        res["retirados"] += _quitar_facturas(base / f"mes={mes}", cambiadas)
+    for mes, grupo in nuevas.groupby(meses, sort=True):
+        folder = base / f"mes={mes}"
+        _escribir(folder, grupo)
+        if len(_partes(folder)) > MAX_PARTES:
+            compactar(folder)
+    res["nuevos"] = len(nuevas)
+    actualizar_rollups(root, provider, cambiadas, nuevas)
+    for factura, (filas, huella, _) in cambiadas.items():
+        indice[factura] = {"huella": huella, "filas": len(filas), "meses": sorted(set(_meses(filas["fecha"]))),
+                           "guardada": datetime.datetime.now().isoformat(timespec="seconds")}
+    _guardar_indice(root, provider, indice)
+    return res
+
+def retirar_factura(provider: str, factura: str, root: Path) -> int:
+    """Quita del histórico y de los rollups los viajes de una factura; devuelve cuántos."""
+    indice = _indice(root, provider)
+    previa = indice.pop(factura, None)
+    if previa is None:
+        return 0
+    quitadas = sum(_quitar_facturas(root / f"provider={provider}" / f"mes={mes}", [factura]) for mes in previa["meses"])
+    actualizar_rollups(root, provider, [factura], None)
+    _guardar_indice(root, provider, indice)
+    return quitadas
+
+def _inicio_periodo(fecha: pd.Series, periodo: str) -> pd.Series:
+    dia = fecha.dt.normalize()
+    if periodo == "dia":
+        return dia
+    if periodo == "semana":  # semanas de lunes a domingo
+        return dia - pd.to_timedelta(dia.dt.weekday, unit="D")
+    return dia - pd.to_timedelta(dia.dt.day - 1, unit="D")
+
+def _rollup_vacio(claves=ROLLUP_KEYS) -> pd.DataFrame:
+    tipos = {"provider": "str", "factura": "str", "conductor": "str", "periodo": "datetime64[us]", "viajes": "int64"}
+    return pd.DataFrame({c: pd.Series(dtype=tipos.get(c, "float64")) for c in claves + ROLLUP_MEDIDAS})
+
+def _agregar(df: pd.DataFrame, claves=ROLLUP_KEYS) -> pd.DataFrame:
+    if df.empty:
+        return _rollup_vacio(claves)
+    out = df.groupby(claves, dropna=False, observed=True, sort=True)[ROLLUP_MEDIDAS].sum().reset_index()
+    out["viajes"] = out["viajes"].astype("int64")
+    if "periodo" in out:
+        out["periodo"] = out["periodo"].astype("datetime64[us]")
+    return out
+
+def _rollup_delta(viajes: pd.DataFrame, periodo: str) -> pd.DataFrame:
+    delta = pd.DataFrame({
+        "provider": viajes["provider"].astype(str),
+        "factura": viajes["factura"].astype(str),
+        "conductor": viajes["conductor"].astype(str),
+        "periodo": _inicio_periodo(pd.to_datetime(viajes["fecha"], errors="coerce"), periodo),
+        "viajes": 1,
+        **{c: pd.to_numeric(viajes[c], errors="coerce").fillna(0.0) for c in ROLLUP_MEDIDAS[1:]},
+    })
+    return _agregar(delta)
+
+def _rollup_path(root: Path, periodo: str) -> Path:
+    return root / ROLLUP_DIR / f"conductor_{periodo}.parquet"
+
+def _escribir_rollup(path: Path, df: pd.DataFrame):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+
+def _construir_rollups(root: Path):
+    columnas = ["provider", "factura", "fecha", "conductor"] + ROLLUP_MEDIDAS[1:]
+    viajes = consultar(root, columnas=columnas) if _hay_historial(root) else pd.DataFrame(columns=columnas)
+    for periodo in PERIODOS:
+        _escribir_rollup(_rollup_path(root, periodo), _rollup_delta(viajes, periodo))
+
+def _asegurar_rollups(root: Path):
+    """Crea los rollups desde el histórico si faltan (p. ej. un histórico anterior a ellos)."""
+    if not all(_rollup_path(root, p).exists() for p in PERIODOS):
+        _construir_rollups(root)
+
+def actualizar_rollups(root: Path, provider: str, facturas, viajes: pd.DataFrame = None):
+    """Sustituye en los rollups las filas de `facturas` del provider por las de `viajes` (o las quita)."""
+    quitar = [str(f) for f in facturas]
+    with _rollup_lock:
+        _asegurar_rollups(root)
+        for periodo in PERIODOS:
+            path = _rollup_path(root, periodo)
+            actual = pd.read_parquet(path)
+            actual = actual[~((actual["provider"] == provider) & actual["factura"].isin(quitar))]
+            partes = [actual] + ([_rollup_delta(viajes, periodo)] if viajes is not None and len(viajes) else [])
+            _escribir_rollup(path, pd.concat(partes, ignore_index=True).sort_values(ROLLUP_KEYS, ignore_index=True))
+
+def reconstruir_rollups(root: Path):
+    """Recalcula los rollups desde el histórico completo (p. ej. tras borrar particiones)."""
+    with _rollup_lock:
+        _construir_rollups(root)
+
+def rollup(root: Path, periodo: str = "mes", provider: str = None, conductor: str = None,
+           desde=None, hasta=None, facturas=None) -> pd.DataFrame:
+    """Totales por provider, conductor y periodo (inicio del día, semana o mes).
+
+    `facturas` limita la suma a esas facturas (p. ej. las de la ejecución actual).
+    """
+    claves = ["provider", "conductor", "periodo"]
+    if not root.exists():
+        return _rollup_vacio(claves)
+    with _rollup_lock:
+        _asegurar_rollups(root)
+    filtros = []
+    if provider:
+        filtros.append(("provider", "==", provider))
+    if conductor:
+        filtros.append(("conductor", "==", conductor))
+    if facturas is not None:
+        filtros.append(("factura", "in", [str(f) for f in facturas] or [""]))
+    if desde is not None:
+        filtros.append(("periodo", ">=", _inicio_periodo(pd.Series([pd.Timestamp(desde)]), periodo)[0].to_pydatetime()))
+    if hasta is not None:
+        filtros.append(("periodo", "<=", pd.Timestamp(hasta).to_pydatetime()))
+    return _agregar(pd.read_parquet(_rollup_path(root, periodo), filters=filtros or None), claves)
+
+def resumen_conductores(root: Path, provider: str = None, facturas=None) -> pd.DataFrame:
+    """Totales por conductor desde el rollup mensual, sin leer viajes."""
+    df = rollup(root, "mes", provider, facturas=facturas)
+    return df.groupby("conductor", sort=True)[["viajes", "bruto", "comision", "neto"]].sum().reset_index()
+
+def consultar(root: Path, conductor: str = None, provider: str = None, desde=None, hasta=None,
+              meses: int = None, columnas=None) -> pd.DataFrame:
+    """Viajes del histórico filtrados por conductor, provider y rango de fechas.
+
+    Los filtros de provider y fecha se traducen a las particiones (provider, mes),
+    así que solo se abren los ficheros de los meses pedidos. `meses=6` equivale a
+    desde el día 1 del mes de hace cinco meses hasta hoy.
+    """
+    if not _hay_historial(root):
+        return pd.DataFrame(columns=columnas or COLUMNS + ["provider", "mes"])
+    if meses:
+        hoy = pd.Timestamp.today().normalize()
+        desde = (hoy.to_period("M") - (meses - 1)).to_timestamp()
+    desde = pd.Timestamp(desde) if desde is not None else None
+    hasta = pd.Timestamp(hasta) if hasta is not None else None
+
+    filtro = ds.field("mes") != SIN_FECHA if (desde is not None or hasta is not None) else None
+    def y(expr):
+        return expr if filtro is None else filtro & expr
+    if provider:
+        filtro = y(ds.field("provider") == provider)
+    if desde is not None:
+        filtro = y((ds.field("mes") >= desde.strftime("%Y-%m")) & (ds.field("fecha") >= pa.scalar(desde.to_pydatetime(), pa.timestamp("us"))))
+    if hasta is not None:
+        filtro = y((ds.field("mes") <= hasta.strftime("%Y-%m")) & (ds.field("fecha") <= pa.scalar(hasta.to_pydatetime(), pa.timestamp("us"))))
+    if conductor:
+        filtro = y(ds.field("conductor") == conductor)
+    dataset = ds.dataset(root, format="parquet", partitioning=_partitioning())
+    return dataset.to_table(columns=columnas, filter=filtro).to_pandas()
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Consulta el histórico de viajes")
+    ap.add_argument("--root", type=Path, default=Path(os.getenv("STARLAB_BASE", "/data/data/com.termux/files/home/starlab2")) / "data" / "historial")
+    ap.add_argument("--conductor")
+    ap.add_argument("--provider")
+    ap.add_argument("--meses", type=int, help="últimos N meses (incluido el actual)")
+    ap.add_argument("--desde")
+    ap.add_argument("--hasta")
+    ap.add_argument("--rollup", choices=PERIODOS, help="muestra los totales por periodo en vez de los viajes")
+    ap.add_argument("--reconstruir", action="store_true", help="recalcula los rollups desde el histórico")
+    ap.add_argument("--csv", type=Path, help="guarda el resultado en este CSV")
+    args = ap.parse_args(argv)
+    if not disponible():
+        print("El histórico necesita pyarrow")
+        return 1
+    if args.reconstruir:
+        reconstruir_rollups(args.root)
+    if args.rollup:
+        desde = (pd.Timestamp.today().to_period("M") - (args.meses - 1)).to_timestamp() if args.meses else args.desde
+        df = rollup(args.root, args.rollup, args.provider, args.conductor, desde, args.hasta)
+        if args.csv:
+            df.to_csv(args.csv, index=False)
+        print(df.to_string(index=False) if len(df) else "Sin datos")
+        return 0
+    df = consultar(args.root, args.conductor, args.provider, args.desde, args.hasta, args.meses)
+    if args.csv:
+        df.to_csv(args.csv, index=False)
+    print(f"Viajes: {len(df)} | bruto: {df['bruto'].sum():.2f} | comisión: {df['comision'].sum():.2f} | neto: {df['neto'].sum():.2f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
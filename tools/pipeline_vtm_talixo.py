@@ -1,7 +1,14 @@
-import os, re, json, datetime, shutil, subprocess
+import os, re, json, datetime, shutil, subprocess, argparse, hashlib, time, inspect, tempfile
+import ctypes, ctypes.util, dataclasses, select, signal, struct, threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+from jinja2 import Environment, FileSystemLoader
+
+import historial
 
 # Intentamos usar pdfplumber; si está tabula (requiere Java), también
 USE_TABULA = False
@@ -10,13 +17,24 @@ try:
 except Exception:
     pdfplumber = None
 
+# Con jpype, tabula-py (>= 2.8) arranca la JVM dentro del proceso una sola vez
+TABULA_JPYPE = False
 try:
     import tabula  # tabula-py
     USE_TABULA = True
+    import jpype  # noqa: F401
+    TABULA_JPYPE = "force_subprocess" in inspect.signature(tabula.read_pdf).parameters
 except Exception:
     pass
 
-BASE = Path("/data/data/com.termux/files/home/starlab2")
+# Parquet para la caché de extracción si hay pyarrow; si no, pickle de pandas
+try:
+    import pyarrow  # noqa: F401
+    CACHE_EXT = "parquet"
+except Exception:
+    CACHE_EXT = "pkl"
+
+BASE = Path(os.getenv("STARLAB_BASE", "/data/data/com.termux/files/home/starlab2"))
 IN_VTM = BASE / "invoices" / "vtm"
 IN_TALIXO = BASE / "invoices" / "talixo"
 DATA = BASE / "data"
@@ -24,12 +42,28 @@ OUT = BASE / "output"
 OUT_VTM_DRIVERS = OUT / "vtm_por_conductor"
 OUT_TALIXO_DRIVERS = OUT / "talixo_por_conductor"
 TARIFAS = json.load(open(BASE / "tools" / "tarifas.json", "r"))
+# Registro de layouts: provider -> firma de cabecera -> {header, columns, date_format}
+LAYOUTS_PATH = BASE / "tools" / "layouts.json"
+LAYOUTS = json.load(open(LAYOUTS_PATH, "r")) if LAYOUTS_PATH.exists() else {}
+LAYOUTS_PENDIENTES = DATA / "layouts_pendientes"
+
+CACHE_DIR = DATA / "cache_extraccion"
+HISTORIAL_DIR = DATA / "historial"  # Parquet provider=/mes=, ver tools/historial.py
 
 TODAY = datetime.datetime.now().strftime("%Y%m%d")
+# Subir al cambiar la extracción o normalize_df: invalida la caché de extracción
+EXTRACTOR_VERSION = "5"
+# Un cambio en layouts.json también altera las tablas normalizadas
+CACHE_VERSION = EXTRACTOR_VERSION + "-" + hashlib.sha256(json.dumps(LAYOUTS, sort_keys=True).encode()).hexdigest()[:8]
+PAGES_PER_TASK = 4  # páginas por tarea en modo --workers
+EMPTY_COLUMNS = ["fecha","conductor","ruta_servicio","km","bruto","comision","tipo","provider"]
 
 def ensure_dirs():
-    for d in [IN_VTM, IN_TALIXO, DATA, OUT, OUT_VTM_DRIVERS, OUT_TALIXO_DRIVERS]:
+    for d in [IN_VTM, IN_TALIXO, DATA, OUT, OUT_VTM_DRIVERS, OUT_TALIXO_DRIVERS, CACHE_DIR, LAYOUTS_PENDIENTES]:
         d.mkdir(parents=True, exist_ok=True)
+    for provider in PROVIDERS.values():
+        provider.input_dir.mkdir(parents=True, exist_ok=True)
+        provider.drivers_dir.mkdir(parents=True, exist_ok=True)
 
 def clean_money(x):
     if pd.isna(x): return 0.0
@@ -52,6 +86,43 @@ def classify_service(txt):
         return "transfer"
     return "other"
 
+# Camino rápido de clean_money: tras quitar € y comas, número simple que float() acepta tal cual
+MONEY_FAST = re.compile(r"^[+-]?(?:\d+\.?\d*|\.\d+)$")
+SERVICE_PATTERNS = [
+    ("airport", re.compile(r"air")),
+    ("hourly", re.compile(r"hour|hora")),
+    ("long_distance", re.compile(r"long|dist|km")),
+    ("transfer", re.compile(r"transfer|traslado")),
+]
+
+def clean_money_series(col: pd.Series) -> pd.Series:
+    """clean_money por columnas.
+
+    Se trabaja sobre los valores distintos (los importes se repiten mucho); los que no
+    pasan el camino rápido usan clean_money.
+    """
+    if pd.api.types.is_numeric_dtype(col):
+        return col.astype(float).fillna(0.0)
+    codes, uniques = pd.factorize(col)
+    if len(uniques) == 0:
+        return pd.Series(0.0, index=col.index)
+    raw = pd.Series(uniques, dtype=object)
+    s = raw.astype(str).str.replace("€", "", regex=False).str.replace(",", "", regex=False).str.strip()
+    fast = s.str.match(MONEY_FAST).to_numpy(dtype=bool)
+    parsed = np.empty(len(uniques), dtype=float)
+    parsed[fast] = s[fast].astype(float).to_numpy()
+    parsed[~fast] = [clean_money(v) for v in raw[~fast]]
+    # codes == -1: NaN/None -> 0.0 como en clean_money
+    return pd.Series(np.where(codes >= 0, parsed[codes], 0.0), index=col.index)
+
+def classify_service_series(col: pd.Series) -> pd.Series:
+    """classify_service por columnas: mismas reglas y prioridad con np.select sobre los valores distintos."""
+    codes, uniques = pd.factorize(col)
+    t = pd.Series(uniques, dtype=object).astype(str).str.lower()
+    conds = [t.str.contains(pat).to_numpy(dtype=bool) for _, pat in SERVICE_PATTERNS]
+    labels = np.select(conds, [name for name, _ in SERVICE_PATTERNS], "other").astype(object) if len(t) else np.array([], dtype=object)
+    return pd.Series(np.where(codes >= 0, labels[codes] if len(labels) else "other", "other"), index=col.index)
+
 def apply_tarifa(row):
     rules = TARIFAS["rules"]
     com_pct = TARIFAS["commission"]["default_pct"]
@@ -78,75 +149,830 @@ def apply_tarifa(row):
     neto = round(bruto - comision, 2)
     return bruto, comision, neto
 
-def extract_tables_pdf(pdf_path: Path):
-    """Devuelve lista de DataFrames por cada tabla encontrada (pdfplumber o tabula)."""
-    dfs = []
-    if pdfplumber:
+def round_like_python(x: np.ndarray, ndigits: int = 2) -> np.ndarray:
+    """np.round con el mismo resultado que round() de Python.
+
+    Solo difieren en casi-empates (x*10^n muy cerca de .5), que se resuelven con round().
+    """
+    x = np.asarray(x, dtype=float)
+    out = np.round(x, ndigits)
+    scaled = x * 10 ** ndigits
+    ties = np.abs(np.abs(scaled - np.trunc(scaled)) - 0.5) < 1e-6
+    if ties.any():
+        out[ties] = [round(float(v), ndigits) for v in x[ties]]  # float(): np.float64.__round__ no es el de Python
+    return out
+
+class TariffEngine:
+    """Reglas de tarifas.json compiladas para aplicarse por columnas (equivale a apply_tarifa)."""
+
+    def __init__(self, tarifas: dict):
+        self.rules = tarifas["rules"]
+        self.default = self.rules["other"]
+        self.com_pct = tarifas["commission"]["default_pct"]
+
+    def apply(self, df: pd.DataFrame):
+        """Devuelve (bruto, comision, neto) como arrays para todo el DataFrame."""
+        n = len(df)
+        tipo = df["tipo"].to_numpy(dtype=object) if "tipo" in df else np.full(n, None, dtype=object)
+        tipo = np.where(pd.isna(tipo) | (tipo == ""), "other", tipo)
+        km = pd.to_numeric(df["km"], errors="coerce").to_numpy(dtype=float, na_value=np.nan) if "km" in df else np.zeros(n)
+        horas = df["horas"].astype(float).to_numpy() if "horas" in df else np.ones(n)
+        bruto = df["bruto"].to_numpy(dtype=float, na_value=np.nan) if "bruto" in df else np.zeros(n)
+        comision = df["comision"].to_numpy(dtype=float, na_value=np.nan) if "comision" in df else np.zeros(n)
+
+        # Bruto estimado por tipo: una máscara por regla
+        estimado = np.zeros(n)
+        conocidos = np.zeros(n, dtype=bool)
+        for nombre, rule in self.rules.items():
+            mask = tipo == nombre
+            conocidos |= mask
+            estimado[mask] = self._estimate(rule, mask, km, horas)
+        otros = ~conocidos
+        estimado[otros] = self._estimate(self.default, otros, km, horas)
+
+        bruto = np.where(bruto == 0, estimado, bruto)
+        comision = np.where(comision == 0, round_like_python(bruto * self.com_pct), comision)
+        neto = round_like_python(bruto - comision)
+        return bruto, comision, neto
+
+    @staticmethod
+    def _estimate(rule, mask, km, horas):
+        if rule["type"] == "flat":
+            return rule["value"]
+        if rule["type"] == "per_hour":
+            return rule["value"] * horas[mask]
+        if rule["type"] == "per_km":
+            return rule["value"] * km[mask]
+        return 0.0
+
+TARIFF_ENGINE = TariffEngine(TARIFAS)
+
+def merge_tariffs(base: dict, overrides: dict) -> dict:
+    """tarifas.json con las sobreescrituras de un provider (regla a regla, clave a clave)."""
+    merged = json.loads(json.dumps(base))
+    for key, value in (overrides or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            for k, v in value.items():
+                merged[key][k] = {**merged[key][k], **v} if isinstance(v, dict) and isinstance(merged[key].get(k), dict) else v
+        else:
+            merged[key] = value
+    return merged
+
+@dataclasses.dataclass
+class Provider:
+    """Plataforma de facturas: carpeta de entrada, layouts, tarifas propias y nombre de sus salidas."""
+    name: str
+    input_dir: Path
+    tag: str | None = None  # prefijo de las salidas (<tag>_resumen_general.xlsx, ...); por defecto name
+    layouts: str | None = None  # clave de layouts.json; por defecto name
+    tariffs: dict = dataclasses.field(default_factory=dict)  # se superpone a tarifas.json
+    drivers_dir: Path | None = None
+
+    def __post_init__(self):
+        self.tag = self.tag or self.name
+        self.layouts = self.layouts or self.name
+        self.drivers_dir = self.drivers_dir or OUT / f"{self.tag}_por_conductor"
+        self.engine = TariffEngine(merge_tariffs(TARIFAS, self.tariffs)) if self.tariffs else TARIFF_ENGINE
+
+PROVIDERS = {}
+LAYOUT_KEYS = {}  # provider -> clave en layouts.json
+
+def register_provider(provider: Provider):
+    PROVIDERS[provider.name] = provider
+    LAYOUT_KEYS[provider.name] = provider.layouts
+    return provider
+
+def load_providers(path: Path = BASE / "tools" / "proveedores.json"):
+    """Registra los providers de proveedores.json: {nombre: {input, tag, layouts, tariffs}}.
+
+    `input` es relativa a BASE. Sin fichero se registran VTM y Talixo con sus rutas de siempre.
+    """
+    declared = json.load(open(path, "r")) if path.exists() else {"vtm": {}, "talixo": {}}
+    for name, conf in declared.items():
+        register_provider(Provider(
+            name=name,
+            input_dir=BASE / conf.get("input", f"invoices/{name}"),
+            tag=conf.get("tag"),
+            layouts=conf.get("layouts"),
+            tariffs=conf.get("tariffs") or {},
+        ))
+
+load_providers()
+
+TOTAL_LINE = re.compile(r"^(?:sub)?total\b[^\d€-]*(-?€?\s*[\d.,]+)\s*$", re.I)
+NUMBER_CELL = re.compile(r"^(?:-?€?\s*[\d.,]+)?$")
+
+class TextLayout:
+    """Layout conocido listo para leerse de la capa de texto (sin detección de tablas).
+
+    Cada columna empieza donde empieza su celda de cabecera (tablas alineadas a la
+    izquierda); una palabra va a la última columna que empieza antes que ella.
+    """
+
+    def __init__(self, header, columns: dict, date_format: str):
+        self.header = header
+        self.text = " ".join(header)
+        self.sizes = [len(c.split()) for c in header]
+        self.fecha = header.index(columns["fecha"])
+        self.bruto = header.index(columns["bruto"]) if columns.get("bruto") in header else None
+        self.numbers = [header.index(columns[f]) for f in ("km", "bruto", "comision") if columns.get(f) in header]
+        self.date_format = date_format
+
+    def bands(self, line):
+        starts, k = [], 0
+        for n in self.sizes:
+            starts.append(line[k]["x0"] - 1)
+            k += n
+        return starts[1:]
+
+    def is_row(self, cells) -> bool:
         try:
-            with pdfplumber.open(str(pdf_path)) as pdf:
-                for page in pdf.pages:
-                    tables = page.extract_tables()
-                    for t in tables or []:
-                        df = pd.DataFrame(t)
-                        # descartar tablas de 1-2 columnas que son cabeceras
-                        if df.shape[1] >= 3 and df.shape[0] >= 2:
-                            dfs.append(df)
-        except Exception as e:
-            pass
-    if not dfs and USE_TABULA:
+            datetime.datetime.strptime(cells[self.fecha], self.date_format)
+        except ValueError:
+            return False
+        return True
+
+    def valid(self, cells) -> bool:
+        # Una palabra en la columna equivocada deja texto en las columnas numéricas
+        return all(NUMBER_CELL.match(cells[i]) for i in self.numbers)
+
+_text_layouts = {}
+
+def provider_layouts(provider: str) -> dict:
+    return LAYOUTS.get(LAYOUT_KEYS.get(provider, provider) or "", {})
+
+def text_layouts(provider: str):
+    """TextLayouts del provider: layouts.json con formato de fecha y sin "text_layer": false."""
+    if provider not in _text_layouts:
+        found = []
+        for layout in provider_layouts(provider).values():
+            header, columns = layout.get("header") or [], layout.get("columns") or {}
+            if (layout.get("text_layer", True) and layout.get("date_format") and header and all(header)
+                    and columns.get("fecha") in header):
+                found.append(TextLayout(header, columns, layout["date_format"]))
+        _text_layouts[provider] = found
+    return _text_layouts[provider]
+
+def page_lines(words, tol: float = 3):
+    """Agrupa las palabras por línea (misma `top` con tolerancia), en orden de lectura."""
+    lines = []
+    for w in sorted(words, key=lambda w: (round(w["top"]), w["x0"])):
+        if lines and abs(w["top"] - lines[-1][0]["top"]) <= tol:
+            lines[-1].append(w)
+        else:
+            lines.append([w])
+    return [sorted(line, key=lambda w: w["x0"]) for line in lines]
+
+def text_rows(layout: TextLayout, bounds, lines, texts):
+    """Filas de la tabla en `lines` (las que siguen a la cabecera) repartidas por `bounds`, o None."""
+    rows, ended, total = [], False, None
+    for line, text in zip(lines, texts):
+        cells = [[] for _ in layout.header]
+        for w in line:
+            cells[int(np.searchsorted(bounds, w["x0"], side="right"))].append(w["text"])
+        cells = [" ".join(c) for c in cells]
+        if layout.is_row(cells):
+            if ended or not layout.valid(cells):
+                return None
+            rows.append(cells)
+            continue
+        ended = ended or bool(rows)
+        m = TOTAL_LINE.match(text)
+        if m:
+            total = clean_money(m.group(1).replace(" ", ""))
+    if not rows:
+        return None
+    if total is not None and layout.bruto is not None:
+        suma = clean_money_series(pd.Series([r[layout.bruto] for r in rows])).sum()
+        if abs(suma - total) > 0.01:
+            return None
+    return pd.DataFrame([layout.header] + rows)
+
+def parse_text_layer(page, layouts, previous: dict = None):
+    """Lee la tabla de viajes de la capa de texto de `page` con un layout conocido.
+
+    Devuelve un DataFrame como los de extract_tables (cabecera en la primera fila)
+    o None si no aparece ninguna cabecera conocida o falla la comprobación:
+    - las filas (fecha válida) son consecutivas: una fila tras una línea que no lo es
+      indica celdas partidas en varias líneas;
+    - las columnas numéricas (km, importe, comisión) solo contienen números;
+    - si la página trae una línea "Total", la suma de la columna de importe coincide.
+    `previous` guarda el layout y las columnas de la página anterior del mismo PDF leída
+    así: una página sin cabecera se lee con ellos (continuación de la tabla), con las
+    mismas comprobaciones.
+    """
+    lines = page_lines(page.extract_words())
+    texts = [" ".join(w["text"] for w in line).lower() for line in lines]
+    for layout in layouts:
+        if layout.text in texts:
+            h = texts.index(layout.text)
+            bounds = layout.bands(lines[h])
+            df = text_rows(layout, bounds, lines[h + 1:], texts[h + 1:])
+            break
+    else:
+        if not previous:
+            return None
+        layout, bounds = previous["layout"], previous["bounds"]
+        df = text_rows(layout, bounds, lines, texts)
+    if previous is not None:
+        previous.clear()
+        if df is not None:
+            previous.update(layout=layout, bounds=bounds)
+    return df
+
+# Triage de páginas: portadas, condiciones y páginas en blanco no llegan a la extracción
+TRIAGE_MIN_CHARS = 40
+TRIAGE_MIN_EDGES = 4  # sin al menos un rectángulo de líneas, extract_tables no encuentra tablas
+HEADER_KEYWORDS = ("fecha", "date", "driver", "conductor", "chofer", "total", "importe")
+TRIAGE_MIN_DIGITS = 0.05  # fracción de dígitos por debajo de la cual una página es prosa, no una tabla
+
+def page_triage(page):
+    """Motivo para descartar la página sin extraer tablas, o None si puede tenerlas.
+
+    Solo usa los objetos ya parseados (caracteres y líneas), sin análisis de layout.
+    Una página sin palabras de cabecera puede ser la continuación de una tabla de
+    viajes, así que solo se descarta si además tiene pocas líneas o casi no tiene cifras.
+    """
+    chars = page.chars
+    if len(chars) < TRIAGE_MIN_CHARS:
+        return "sin_texto"
+    text = "".join(c["text"] for c in chars).lower()
+    if not any(k in text for k in HEADER_KEYWORDS):
+        digits = sum(ch.isdigit() for ch in text) / len(text)
+        if page_edges(page) < TRIAGE_MIN_EDGES or digits < TRIAGE_MIN_DIGITS:
+            return "sin_cabecera"
+    return None
+
+def page_edges(page) -> int:
+    return len(page.lines) + len(page.rects) + len(page.curves)
+
+def page_tables(page, layouts, stats: Counter, previous: dict = None):
+    """Tablas (DataFrames) de una página: triage, capa de texto y, si hace falta, detección.
+
+    `previous` (ver parse_text_layer) solo pasa de una página leída por la capa de texto
+    a la siguiente; cualquier otro camino lo vacía.
+    """
+    stats["paginas"] += 1
+    t = time.perf_counter()
+    page.objects  # parseo de la página: lo paga cualquier camino, no cuenta como triage
+    stats["seg_parseo"] += time.perf_counter() - t
+    t = time.perf_counter()
+    motivo = page_triage(page)
+    stats["seg_triage"] += time.perf_counter() - t
+    if motivo:
+        if previous is not None:
+            previous.clear()
+        stats["omitidas"] += 1
+        stats[f"omitidas_{motivo}"] += 1
+        return []
+    fast = parse_text_layer(page, layouts, previous) if layouts else None
+    if fast is not None:
+        stats["capa_texto"] += 1
+        return [fast]
+    if page_edges(page) < TRIAGE_MIN_EDGES:
+        stats["omitidas"] += 1
+        stats["omitidas_sin_lineas"] += 1
+        return []
+    t = time.perf_counter()
+    tables = page.extract_tables()
+    stats["seg_tablas"] += time.perf_counter() - t
+    stats["deteccion_tablas"] += 1
+    dfs = []
+    for t in tables or []:
+        df = pd.DataFrame(t)
+        # descartar tablas de 1-2 columnas que son cabeceras
+        if df.shape[1] >= 3 and df.shape[0] >= 2:
+            dfs.append(df)
+    return dfs
+
+def iter_page_tables(pdf_path: Path, start: int = 0, stop: int | None = None, provider: str = None, stats: Counter = None):
+    """Genera, página a página, las tablas de las páginas [start, stop) con pdfplumber.
+
+    Las páginas que page_triage descarta no se procesan. Con layouts conocidos del
+    provider se prueba antes parse_text_layer; la detección de tablas solo corre en
+    las páginas donde no encaja y que tienen líneas; las páginas de continuación sin
+    cabecera se leen con el layout de la anterior. `stats` acumula páginas por
+    camino y los tiempos de triage y de detección. Cada página se cierra (se vacía su
+    caché de objetos) en cuanto se procesa, así la memoria no crece con el PDF.
+    """
+    if not pdfplumber:
+        return
+    stats = stats if stats is not None else Counter()
+    layouts, previous = text_layouts(provider), {}
+    try:
+        with pdfplumber.open(str(pdf_path)) as pdf:
+            for page in pdf.pages[start:stop]:
+                try:
+                    tables = page_tables(page, layouts, stats, previous)
+                finally:
+                    page.close()
+                yield tables
+    except Exception as e:
+        pass
+
+def extract_tables_pages(pdf_path: Path, start: int = 0, stop: int | None = None, provider: str = None, stats: Counter = None):
+    """Tablas (DataFrames) de las páginas [start, stop); ver iter_page_tables."""
+    return [df for tables in iter_page_tables(pdf_path, start, stop, provider, stats) for df in tables]
+
+def extract_tables_tabula(pdf_path: Path):
+    if not USE_TABULA:
+        return []
+    try:
+        return tabula.read_pdf(str(pdf_path), pages="all", multiple_tables=True, lattice=True)
+    except Exception:
+        return []
+
+def tabula_json_tables(raw):
+    """DataFrames desde la salida JSON de tabula-java, como los devuelve read_pdf (cabecera = primera fila)."""
+    dfs = []
+    for table in raw:
+        rows = [[cell.get("text") or np.nan for cell in row] for row in table.get("data", [])]
+        if rows:
+            header = ["" if c is np.nan else c for c in rows[0]]
+            dfs.append(pd.DataFrame(rows[1:], columns=header))
+    return dfs
+
+def extract_tables_tabula_batch(pdf_paths):
+    """Fallback de tabula para varios PDFs pagando el arranque de la JVM una sola vez.
+
+    Con jpype la JVM del proceso sigue viva entre llamadas a read_pdf. Sin él, cada
+    read_pdf lanzaría un `java` nuevo, así que todos los PDFs van en una única
+    invocación por lotes (convert_into_by_batch a JSON sobre un directorio temporal).
+    Devuelve {pdf: [DataFrames]} para cada PDF recibido.
+    """
+    found = {pdf: [] for pdf in pdf_paths}
+    if not USE_TABULA or not pdf_paths:
+        return found
+    if TABULA_JPYPE or len(pdf_paths) == 1:
+        return {pdf: extract_tables_tabula(pdf) for pdf in pdf_paths}
+    with tempfile.TemporaryDirectory(prefix="starlab_tabula_") as tmp:
+        outputs = {}
+        for i, pdf in enumerate(pdf_paths):
+            link = Path(tmp) / f"{i:05d}.pdf"
+            try:
+                os.symlink(Path(pdf).resolve(), link)
+            except OSError:
+                shutil.copyfile(pdf, link)
+            outputs[pdf] = link.with_suffix(".json")
         try:
-            dfs = tabula.read_pdf(str(pdf_path), pages="all", multiple_tables=True, lattice=True)
+            tabula.convert_into_by_batch(tmp, output_format="json", pages="all", lattice=True)
         except Exception:
-            pass
+            return found
+        for pdf, out in outputs.items():
+            try:
+                with open(out, "r", encoding="utf-8") as f:
+                    found[pdf] = tabula_json_tables(json.load(f))
+            except Exception:
+                continue
+    return found
+
+def tabula_fallback(pdfs, provider: str):
+    """Tablas normalizadas de tabula para los PDFs en los que pdfplumber no encontró nada (en orden)."""
+    found = extract_tables_tabula_batch(pdfs)
+    return [normalize_tables(found[pdf], provider) for pdf in pdfs]
+
+def extract_tables_pdf(pdf_path: Path, provider: str = None, stats: Counter = None):
+    """Devuelve lista de DataFrames por cada tabla encontrada (pdfplumber o tabula)."""
+    dfs = extract_tables_pages(pdf_path, provider=provider, stats=stats)
+    if not dfs:
+        dfs = extract_tables_tabula(pdf_path)
     return dfs
 
-def normalize_df(df: pd.DataFrame):
-    """Heurística para mapear columnas a: fecha, conductor, servicio/ruta, km, bruto, comision"""
-    # Normaliza headers
-    df = df.copy()
-    df = df.rename(columns={c: str(c).strip().lower() for c in df.columns})
-    cols = list(df.columns)
+FIELDS = ["fecha","conductor","ruta_servicio","km","bruto","comision"]
+FIELD_HINTS = {
+    "fecha": ("date","fecha"),
+    "conductor": ("driver","conductor","chofer"),
+    "ruta_servicio": ("service","servicio","route","ruta","desc"),
+    "km": ("km","kilomet"),
+    "bruto": ("total","importe","amount","bruto"),
+    "comision": ("comm","comis","commission"),
+}
+DATE_FORMATS = ["%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%Y-%m-%d %H:%M", "%d/%m/%Y %H:%M", "%d.%m.%Y %H:%M"]
+_known_layouts = {}  # (provider, firma) -> posiciones por campo y formato de fecha
+_reported_layouts = set()  # (provider, firma) ya registradas en layouts_pendientes en este proceso
+
+class HeaderlessTable(ValueError):
+    """Tabla de pdfplumber sin cabecera (continuación de la página anterior) y sin layout previo que reutilizar."""
+
+def is_data_row(cells) -> bool:
+    """La fila parece un viaje y no una cabecera: alguna celda es una fecha o hay 2+ números."""
+    cells = [re.sub(r"\s+", " ", str(c)).strip() for c in cells if c is not None]
+    for c in cells:
+        for fmt in DATE_FORMATS:
+            try:
+                datetime.datetime.strptime(c, fmt)
+                return True
+            except ValueError:
+                continue
+    return sum(1 for c in cells if re.search(r"\d", c) and NUMBER_CELL.match(c)) >= 2
+
+def split_header(df: pd.DataFrame, prev_header=None):
+    """Separa cabecera y cuerpo. pdfplumber deja la cabecera en la primera fila; tabula, en las columnas.
+
+    Si la primera fila de una tabla de pdfplumber es un viaje (página de continuación),
+    se reutiliza `prev_header`, la cabecera de la tabla anterior del mismo PDF, cuando
+    tiene el mismo número de columnas; si no, HeaderlessTable.
+    """
+    if isinstance(df.columns, pd.RangeIndex) and len(df):
+        if is_data_row(df.iloc[0]):
+            if prev_header is None or len(prev_header) != df.shape[1]:
+                raise HeaderlessTable(f"tabla de {df.shape[1]} columnas sin cabecera")
+            header, body = list(prev_header), df
+        else:
+            header, body = list(df.iloc[0]), df.iloc[1:]
+    else:
+        header, body = list(df.columns), df
+    header = [re.sub(r"\s+", " ", str(c if c is not None else "")).strip().lower() for c in header]
+    body = body.reset_index(drop=True)
+    body.columns = range(body.shape[1])
+    return header, body
 
+def layout_signature(header) -> str:
+    return hashlib.sha1("|".join(header).encode("utf-8")).hexdigest()[:12]
+
+def guess_columns(header):
+    """Heurística de subcadenas: primera columna que contiene alguna pista, por campo."""
     def pick(*cands):
         for c in cands:
-            for cc in cols:
+            for i, cc in enumerate(header):
                 if c in cc:
-                    return cc
+                    return i
         return None
+    return {field: pick(*hints) for field, hints in FIELD_HINTS.items()}
+
+def guess_date_format(values):
+    muestra = [v for v in (str(x).strip() for x in values[:50]) if v and v.lower() != "nan"]
+    for fmt in DATE_FORMATS:
+        if muestra and pd.to_datetime(pd.Series(muestra), format=fmt, errors="coerce").notna().all():
+            return fmt
+    return None
+
+def known_layout(provider: str, signature: str, header):
+    key = (provider, signature)
+    if key not in _known_layouts:
+        layout = provider_layouts(provider).get(signature)
+        if layout is None:
+            return None
+        pos = {field: (header.index(name) if name in header else None) for field, name in layout.get("columns", {}).items()}
+        _known_layouts[key] = ({field: pos.get(field) for field in FIELDS}, layout.get("date_format"))
+    return _known_layouts[key]
 
-    col_fecha = pick("date","fecha")
-    col_driver = pick("driver","conductor","chofer")
-    col_desc = pick("service","servicio","route","ruta","desc")
-    col_km = pick("km","kilomet")
-    col_total = pick("total","importe","amount","bruto")
-    col_comm = pick("comm","comis","commission")
+def report_unknown_layout(provider: str, signature: str, header, cols, body):
+    """Deja la firma desconocida en data/layouts_pendientes para revisarla (una sola vez)."""
+    path = LAYOUTS_PENDIENTES / f"{provider or 'sin_provider'}_{signature}.json"
+    if (provider, signature) in _reported_layouts or path.exists():
+        return
+    _reported_layouts.add((provider, signature))
+    fecha = cols.get("fecha")
+    propuesta = {
+        "provider": provider,
+        "signature": signature,
+        "header": header,
+        "columns": {field: header[i] for field, i in cols.items() if i is not None},
+        "date_format": guess_date_format(list(body[fecha])) if fecha is not None else None,
+        "ejemplo": body.head(3).astype(str).values.tolist(),
+        "visto": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # "x": si otro proceso o una ejecución anterior ya la registró, no se repite el aviso
+        with open(path, "x", encoding="utf-8") as f:
+            json.dump(propuesta, f, ensure_ascii=False, indent=2)
+    except FileExistsError:
+        return
+    except OSError:
+        pass
+    print(f"Layout desconocido ({provider}) {signature}: {header} -> revisar {path.name}")
+
+def normalize_df(df: pd.DataFrame, provider: str = None, context: dict = None):
+    """Mapea columnas a: fecha, conductor, servicio/ruta, km, bruto, comision.
+
+    Si la firma de la cabecera está en layouts.json se usa su mapeo y formato de
+    fecha; si no, la heurística de guess_columns (y la firma queda pendiente de revisión).
+    `context` lleva la última cabecera vista en el PDF para las tablas de continuación.
+    """
+    context = context if context is not None else {}
+    header, body = split_header(df, context.get("header"))
+    context["header"] = header
+    signature = layout_signature(header)
+    layout = known_layout(provider, signature, header)
+    if layout:
+        cols, date_format = layout
+    else:
+        cols, date_format = guess_columns(header), None
+        report_unknown_layout(provider, signature, header, cols, body)
 
     # construimos out
-    out = pd.DataFrame()
-    out["fecha"] = pd.to_datetime(df[col_fecha], errors="coerce") if col_fecha else pd.NaT
-    out["conductor"] = df[col_driver] if col_driver in df else ""
-    out["ruta_servicio"] = df[col_desc] if col_desc in df else ""
-    out["km"] = df[col_km].apply(clean_money) if col_km in df else 0.0
-    out["bruto"] = df[col_total].apply(clean_money) if col_total in df else 0.0
-    out["comision"] = df[col_comm].apply(clean_money) if col_comm in df else 0.0
-    out["tipo"] = out["ruta_servicio"].apply(classify_service)
+    out = pd.DataFrame(index=body.index)
+    c = cols["fecha"]
+    out["fecha"] = pd.to_datetime(body[c], format=date_format, errors="coerce") if c is not None else pd.NaT
+    out["conductor"] = body[cols["conductor"]] if cols["conductor"] is not None else ""
+    out["ruta_servicio"] = body[cols["ruta_servicio"]] if cols["ruta_servicio"] is not None else ""
+    for field in ("km", "bruto", "comision"):
+        out[field] = clean_money_series(body[cols[field]]) if cols[field] is not None else 0.0
+    out["tipo"] = classify_service_series(out["ruta_servicio"])
     return out
 
-def collect_from_folder(folder: Path, provider: str):
+def normalize_tables(dfs, provider: str, context: dict = None, headerless: list = None):
+    """Normaliza las tablas de un PDF en orden (una tabla sin cabecera hereda la anterior).
+
+    Las tablas sin cabecera antes de la primera que la tiene van a `headerless` si se
+    pasa (un trozo de páginas en --workers: las resuelve collect_parallel con el trozo
+    anterior); si no, se descartan con un aviso.
+    """
+    context = context if context is not None else {}
     rows = []
-    for pdf in sorted(folder.glob("*.pdf")):
-        for df in extract_tables_pdf(pdf):
-            try:
-                norm = normalize_df(df)
-                norm["provider"] = provider
-                rows.append(norm)
-            except Exception:
-                continue
+    for df in dfs:
+        try:
+            norm = normalize_df(df, provider, context)
+            norm["provider"] = provider
+            rows.append(norm)
+        except HeaderlessTable as e:
+            if headerless is not None and "header" not in context:
+                headerless.append(df)
+            else:
+                print(f"[{provider}] Aviso: {e}; se descarta")
+        except Exception:
+            continue
+    return rows
+
+def count_pages(pdf_path: Path) -> int:
+    if not pdfplumber:
+        return 0
+    try:
+        with pdfplumber.open(str(pdf_path)) as pdf:
+            return len(pdf.pages)
+    except Exception:
+        return 0
+
+def _extract_task(pdf_path: Path, start: int, stop: int, provider: str):
+    """Tarea del pool: extrae y normaliza un rango de páginas de un PDF (y sus estadísticas)."""
+    stats, context, headerless = Counter(), {}, []
+    rows = normalize_tables(extract_tables_pages(pdf_path, start, stop, provider, stats), provider, context, headerless)
+    return rows, stats, headerless, context.get("header")
+
+def collect_parallel(pdfs, provider: str, workers: int, stats: Counter = None, pool: ProcessPoolExecutor = None):
+    """Reparte (pdf, rango de páginas) en un pool de procesos (`pool` si se comparte uno).
+
+    Devuelve, por cada PDF y en el mismo orden, la lista de tablas normalizadas
+    (el mismo resultado que la ejecución en serie).
+    """
+    tasks = []
+    for i, pdf in enumerate(pdfs):
+        n = count_pages(pdf)
+        for start in range(0, n, PAGES_PER_TASK):
+            tasks.append((i, pdf, start, min(start + PAGES_PER_TASK, n)))
+    per_pdf = [[] for _ in pdfs]
+    ex = pool or ProcessPoolExecutor(max_workers=workers)
+    try:
+        futures = [(i, ex.submit(_extract_task, pdf, start, stop, provider)) for i, pdf, start, stop in tasks]
+        # Se recogen en el orden de envío (pdf, página), no en el de finalización
+        last = None
+        for i, fut in futures:
+            rows, task_stats, headerless, header = fut.result()
+            if i != last:
+                last, context = i, {}
+            if headerless:
+                # Continuación de una tabla que empezó en el trozo anterior del mismo PDF
+                per_pdf[i].extend(normalize_tables(headerless, provider, context))
+            per_pdf[i].extend(rows)
+            if header is not None:
+                context["header"] = header
+            if stats is not None:
+                stats.update(task_stats)
+    finally:
+        if pool is None:
+            ex.shutdown()
+    # Sin tablas con pdfplumber: mismo fallback que extract_tables_pdf, en un solo lote
+    empty = [i for i in range(len(pdfs)) if not per_pdf[i]]
+    for i, rows in zip(empty, tabula_fallback([pdfs[i] for i in empty], provider)):
+        per_pdf[i] = rows
+    return per_pdf
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def cache_path(digest: str, provider: str) -> Path:
+    return CACHE_DIR / f"{digest}_{provider}_v{CACHE_VERSION}.{CACHE_EXT}"
+
+def cache_load(path: Path):
+    try:
+        df = pd.read_parquet(path) if CACHE_EXT == "parquet" else pd.read_pickle(path)
+    except Exception:
+        return None
+    os.utime(path)  # marca de último uso para la expulsión por antigüedad
+    return df
+
+def cache_store(path: Path, df: pd.DataFrame):
+    tmp = path.with_name(path.name + ".tmp")
+    try:
+        if CACHE_EXT == "parquet":
+            df.to_parquet(tmp, index=False)
+        else:
+            df.to_pickle(tmp)
+        os.replace(tmp, path)
+    except Exception as e:
+        # p.ej. columnas con tipos mezclados que Parquet no acepta: se sigue sin caché
+        tmp.unlink(missing_ok=True)
+        print(f"Aviso: no se pudo guardar en caché {path.name}: {e}")
+
+def cache_evict(max_age_days: float):
+    """Borra entradas de otra versión del extractor y las no usadas en `max_age_days` días."""
+    limite = time.time() - max_age_days * 86400
+    borradas = 0
+    for path in CACHE_DIR.glob("*_v*.*"):
+        version = path.stem.rsplit("_v", 1)[-1]
+        if version != CACHE_VERSION or path.stat().st_mtime < limite:
+            path.unlink(missing_ok=True)
+            borradas += 1
+    return borradas
+
+RUN_REPORT = {}  # provider -> estadísticas de extracción de la ejecución (informe_ejecucion_*.json)
+
+def extraction_report(stats: Counter, pdfs: int, extracted: int) -> dict:
+    """Resumen de la extracción; el ahorro del triage se estima con el tiempo medio de detección."""
+    por_pagina = stats["seg_tablas"] / stats["deteccion_tablas"] if stats["deteccion_tablas"] else 0.0
+    return {
+        "pdfs": pdfs,
+        "pdfs_extraidos": extracted,
+        "paginas": stats["paginas"],
+        "paginas_omitidas": stats["omitidas"],
+        "omitidas_por_motivo": {k[len("omitidas_"):]: v for k, v in sorted(stats.items()) if k.startswith("omitidas_")},
+        "paginas_capa_texto": stats["capa_texto"],
+        "paginas_deteccion_tablas": stats["deteccion_tablas"],
+        "seg_parseo": round(stats["seg_parseo"], 3),
+        "seg_triage": round(stats["seg_triage"], 3),
+        "seg_deteccion_tablas": round(stats["seg_tablas"], 3),
+        "seg_ahorrados_estimados": round(max(stats["omitidas"] * por_pagina - stats["seg_triage"], 0.0), 3),
+    }
+
+class TableSink:
+    """Sumidero en disco de filas normalizadas, escrito por trozos: Parquet si la ruta
+    termina en .parquet (pyarrow), CSV en otro caso. Se escribe en un .tmp y se
+    publica con os.replace al cerrar.
+    """
+
+    def __init__(self, path: Path, columns=None):
+        self.path = path
+        self.columns = columns or EMPTY_COLUMNS
+        self.tmp = path.with_name(path.name + ".tmp")
+        self.rows = 0
+        self._writer = None
+        self._schema = None
+
+    def write(self, df: pd.DataFrame):
+        if df.empty:
+            return
+        df = df.reindex(columns=self.columns)
+        if self.path.suffix == ".parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            # El esquema del primer trozo manda: los siguientes se convierten a él
+            table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+            if self._writer is None:
+                self._schema = table.schema
+                self._writer = pq.ParquetWriter(self.tmp, self._schema)
+            self._writer.write_table(table)
+        else:
+            df.to_csv(self.tmp, mode="a", header=self.rows == 0, index=False)
+        self.rows += len(df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self.rows:
+            os.replace(self.tmp, self.path)
+        elif self.path.suffix == ".parquet":
+            pd.DataFrame(columns=self.columns).to_parquet(self.path, index=False)
+        else:
+            pd.DataFrame(columns=self.columns).to_csv(self.path, index=False)
+
+    def read(self) -> pd.DataFrame:
+        if self.path.suffix == ".parquet":
+            return pd.read_parquet(self.path)
+        return pd.read_csv(self.path, parse_dates=["fecha"])
+
+def stream_pdf(pdf_path: Path, provider: str, stats: Counter, without_tables: list):
+    """Filas normalizadas de un PDF, un DataFrame por página con tablas (modo --stream).
+
+    Si pdfplumber no encuentra ninguna tabla, el PDF se añade a `without_tables` para
+    el fallback de tabula por lotes.
+    """
+    found, context = False, {}
+    for tables in iter_page_tables(pdf_path, provider=provider, stats=stats):
+        found = found or bool(tables)
+        rows = normalize_tables(tables, provider, context)
+        if rows:
+            yield pd.concat(rows, ignore_index=True)
+    if not found:
+        without_tables.append(pdf_path)
+
+def stream_from_folder(pdfs, keys, provider: str, rebuild: bool, stats: Counter):
+    """Extracción con memoria acotada: página a página hacia un sumidero en disco.
+
+    Ningún PDF se tiene entero en memoria: cada página se normaliza, se añade a
+    data/<provider>_extraccion_<fecha>.(parquet|csv) y se libera. Las entradas de caché
+    se leen de una en una y las nuevas se escriben también por trozos (solo con
+    pyarrow; sin él la caché de extracción es pickle y no admite escritura por trozos).
+    Los PDFs sin tablas pasan juntos por tabula al final (una JVM), así que sus filas
+    quedan detrás de las del resto. Devuelve el sumidero cerrado y cuántos PDFs se
+    extrajeron.
+    """
+    sink = TableSink(DATA / f"{provider}_extraccion_{TODAY}.{'parquet' if CACHE_EXT == 'parquet' else 'csv'}", EMPTY_COLUMNS + ["factura"])
+    extracted = 0
+    without_tables, pdf_sinks = [], {}
+    for pdf, key in zip(pdfs, keys):
+        cached = cache_load(key) if key is not None and not rebuild and key.exists() else None
+        if cached is not None:
+            sink.write(cached.assign(factura=pdf.name))
+            continue
+        extracted += 1
+        pdf_sink = pdf_sinks[pdf] = TableSink(key) if key is not None and CACHE_EXT == "parquet" else None
+        for chunk in stream_pdf(pdf, provider, stats, without_tables):
+            sink.write(chunk.assign(factura=pdf.name))
+            if pdf_sink:
+                pdf_sink.write(chunk)
+        if pdf_sink and pdf not in without_tables:
+            pdf_sink.close()
+    for pdf, rows in zip(without_tables, tabula_fallback(without_tables, provider)):
+        for chunk in rows:
+            sink.write(chunk.assign(factura=pdf.name))
+            if pdf_sinks[pdf]:
+                pdf_sinks[pdf].write(chunk)
+        if pdf_sinks[pdf]:
+            pdf_sinks[pdf].close()
+    sink.close()
+    return sink, extracted
+
+def collect_from_folder(folder: Path, provider: str, workers: int = 1, use_cache: bool = True, rebuild: bool = False, stream: bool = False,
+                        pool: ProcessPoolExecutor = None):
+    """Extrae y normaliza los PDFs de `folder`.
+
+    Con caché, solo se extraen los PDFs cuyo SHA-256 (con la versión del extractor)
+    no está en data/cache_extraccion; el resto se lee de allí. `rebuild` ignora y
+    reescribe las entradas existentes. Cada fila lleva en `factura` el nombre de su PDF.
+    `stream` usa stream_from_folder (en serie,
+    memoria acotada) en lugar de reunir todas las tablas antes de concatenarlas; el
+    DataFrame devuelto sí está entero en memoria (lo leen los pasos siguientes), así
+    que con --stream solo el pico de la extracción deja de crecer con los PDFs.
+    """
+    pdfs = sorted(folder.glob("*.pdf"))
+    per_pdf = [None] * len(pdfs)
+    keys = [None] * len(pdfs)
+    if use_cache:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        for i, pdf in enumerate(pdfs):
+            keys[i] = cache_path(file_sha256(pdf), provider)
+            if not stream and not rebuild and keys[i].exists():
+                cached = cache_load(keys[i])
+                if cached is not None:
+                    per_pdf[i] = [cached] if len(cached) else []
+    stats = Counter()
+    if stream:
+        sink, extracted = stream_from_folder(pdfs, keys, provider, rebuild, stats)
+    else:
+        pending = [i for i, rows in enumerate(per_pdf) if rows is None]
+        extracted = len(pending)
+        if workers > 1 and len(pending) > 0:
+            for i, rows in zip(pending, collect_parallel([pdfs[i] for i in pending], provider, workers, stats, pool)):
+                per_pdf[i] = rows
+        else:
+            empty = []
+            for i in pending:
+                tables = extract_tables_pages(pdfs[i], provider=provider, stats=stats)
+                per_pdf[i] = normalize_tables(tables, provider)
+                if not tables:
+                    empty.append(i)
+            # Sin tablas con pdfplumber: fallback de tabula para todos a la vez
+            for i, rows in zip(empty, tabula_fallback([pdfs[i] for i in empty], provider)):
+                per_pdf[i] = rows
+    RUN_REPORT[provider] = report = extraction_report(stats, len(pdfs), extracted)
+    if report["paginas"]:
+        print(f"[{provider}] Páginas: {report['paginas']} | omitidas: {report['paginas_omitidas']} {report['omitidas_por_motivo']} | "
+              f"capa de texto: {report['paginas_capa_texto']} | detección de tablas: {report['paginas_deteccion_tablas']} | "
+              f"ahorro estimado: {report['seg_ahorrados_estimados']:.2f} s")
+    if use_cache:
+        if not stream:
+            for i in pending:
+                rows = per_pdf[i]
+                cache_store(keys[i], pd.concat(rows, ignore_index=True) if rows else pd.DataFrame(columns=EMPTY_COLUMNS))
+        if pdfs:
+            print(f"[{provider}] PDFs: {len(pdfs)} | desde caché: {len(pdfs) - extracted} | extraídos: {extracted}")
+    if stream:
+        # Las filas se cargan enteras: enrich, resumen e informes trabajan sobre el DataFrame completo,
+        # así que el pico de memoria de esos pasos sigue creciendo con el número de viajes
+        return sink.read()
+    # factura = PDF de origen (no se guarda en la caché, que va por contenido): clave del histórico
+    rows = [df.assign(factura=pdf.name) for pdf, r in zip(pdfs, per_pdf) for df in r]
     if not rows:
-        return pd.DataFrame(columns=["fecha","conductor","ruta_servicio","km","bruto","comision","tipo","provider"])
+        return pd.DataFrame(columns=EMPTY_COLUMNS + ["factura"])
     return pd.concat(rows, ignore_index=True)
 
-def enrich_and_totals(df: pd.DataFrame):
+def enrich_and_totals(df: pd.DataFrame, engine: TariffEngine = None):
     # Normalizaciones mínimas
     df["conductor"] = df["conductor"].fillna("").astype(str).str.strip()
     df["ruta_servicio"] = df["ruta_servicio"].fillna("").astype(str)
@@ -155,20 +981,57 @@ def enrich_and_totals(df: pd.DataFrame):
     df["comision"] = pd.to_numeric(df["comision"], errors="coerce").fillna(0.0)
     df["tipo"] = df["tipo"].fillna("other")
 
-    # Aplica tarifas si falta bruto/comisión
-    bs, cs, ns = [], [], []
-    for _, r in df.iterrows():
-        b, c, n = apply_tarifa(r.to_dict())
-        bs.append(b); cs.append(c); ns.append(n)
-    df["bruto"] = bs
-    df["comision"] = cs
-    df["neto"] = ns
+    # Aplica tarifas si falta bruto/comisión (mismo resultado que apply_tarifa fila a fila)
+    df["bruto"], df["comision"], df["neto"] = (engine or TARIFF_ENGINE).apply(df)
     return df
 
-def save_per_driver_reports(df: pd.DataFrame, out_dir: Path, tag: str):
-    """Genera HTML + intenta PDF con wkhtmltopdf si disponible."""
-    html_tpl = (BASE / "templates" / "reporte_conductor.html").read_text(encoding="utf-8")
-    summary_rows = []
+REPORT_COLUMNS = ["fecha","tipo","ruta_servicio","km","bruto","comision","neto"]
+REPORT_MANIFEST = ".reportes.json"  # safe_name -> hash de las filas con que se generó su informe
+DRIVER_REPORTS = {}  # tag -> informes generados / sin cambios (informe_ejecucion_*.json)
+
+def report_template():
+    env = Environment(loader=FileSystemLoader(str(BASE / "templates")), autoescape=True)
+    return env.get_template("reporte_conductor.html")
+
+def driver_rows_hash(driver, g: pd.DataFrame, template_digest: str, months: pd.DataFrame = None) -> str:
+    h = hashlib.sha256(f"{template_digest}|{driver}".encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(g[REPORT_COLUMNS], index=False).to_numpy().tobytes())
+    if months is not None:
+        h.update(pd.util.hash_pandas_object(months, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+def render_driver_report(template, engine, html_path: Path, pdf_path: Path, context: dict):
+    """Escribe el HTML de un conductor y, si hay wkhtmltopdf, su PDF."""
+    html_path.write_text(template.render(**context), encoding="utf-8")
+    if engine:
+        try:
+            subprocess.run([engine, str(html_path), str(pdf_path)], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except Exception:
+            pass
+
+def save_per_driver_reports(df: pd.DataFrame, out_dir: Path, tag: str, workers: int = 4, pool: ThreadPoolExecutor = None,
+                            months: dict = None):
+    """Genera HTML + intenta PDF con wkhtmltopdf si disponible.
+
+    La plantilla se compila y wkhtmltopdf se busca una sola vez; los informes se
+    generan en un pool de `workers` hilos (o en `pool`, si se comparte; wkhtmltopdf
+    es un proceso aparte). Un
+    conductor cuyas filas no han cambiado desde la última ejecución (mismo hash en
+    out_dir/.reportes.json y ficheros presentes) no se vuelve a generar. `months`
+    (conductor -> totales por mes del rollup del histórico) añade la tabla "Por mes".
+    """
+    template = report_template()
+    template_digest = hashlib.sha256(Path(template.filename).read_bytes()).hexdigest()
+    engine = shutil.which("wkhtmltopdf")
+    manifest_path = out_dir / REPORT_MANIFEST
+    try:
+        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    except Exception:
+        manifest = {}
+    generado = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+
+    summary_rows, jobs = [], {}
+    skipped = 0
     for driver, g in df.groupby("conductor"):
         if not str(driver).strip():
             continue
@@ -176,86 +1039,498 @@ def save_per_driver_reports(df: pd.DataFrame, out_dir: Path, tag: str):
         bruto = round(g["bruto"].sum(),2)
         comision = round(g["comision"].sum(),2)
         neto = round(g["neto"].sum(),2)
-        filas_html = "\n".join(
-            f"<tr><td>{(r['fecha'] if pd.notna(r['fecha']) else '')}</td>"
-            f"<td>{r['tipo']}</td><td>{r['ruta_servicio']}</td>"
-            f"<td>{r['km']}</td><td>{r['bruto']}</td><td>{r['comision']}</td><td>{r['neto']}</td></tr>"
-            for _, r in g.iterrows()
-        )
-        html = (html_tpl
-                .replace("{{conductor}}", str(driver))
-                .replace("{{fecha}}", datetime.datetime.now().strftime("%Y-%m-%d %H:%M"))
-                .replace("{{viajes}}", str(viajes))
-                .replace("{{bruto}}", f"{bruto:.2f}")
-                .replace("{{comision}}", f"{comision:.2f}")
-                .replace("{{neto}}", f"{neto:.2f}")
-                .replace("{{filas}}", filas_html)
-               )
+        summary_rows.append({"conductor": driver, "viajes": viajes, "bruto": bruto, "comision": comision, "neto": neto})
+
         safe_name = re.sub(r"[^A-Za-z0-9_-]+","_", str(driver)).strip("_") or "SIN_NOMBRE"
         html_path = out_dir / f"{safe_name}_{tag}.html"
-        html_path.write_text(html, encoding="utf-8")
+        pdf_path = out_dir / f"{safe_name}_{tag}.pdf"
+        meses = (months or {}).get(driver)
+        digest = driver_rows_hash(driver, g, template_digest, meses)
+        if manifest.get(safe_name) == digest and html_path.exists() and (not engine or pdf_path.exists()):
+            skipped += 1
+            continue
+        filas = g[REPORT_COLUMNS].astype({"fecha": object})
+        filas["fecha"] = filas["fecha"].where(g["fecha"].notna(), "")
+        context = {
+            "conductor": str(driver), "fecha": generado, "viajes": viajes,
+            "bruto": f"{bruto:.2f}", "comision": f"{comision:.2f}", "neto": f"{neto:.2f}",
+            "filas": list(filas.itertuples(index=False)),
+            "meses": [] if meses is None else list(meses.itertuples(index=False)),
+        }
+        jobs[safe_name] = (digest, (template, engine, html_path, pdf_path, context))
 
-        # intenta PDF si está wkhtmltopdf
+    if jobs:
+        ex = pool or ThreadPoolExecutor(max_workers=max(1, workers))
         try:
-            subprocess.run(["which","wkhtmltopdf"], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            pdf_path = out_dir / f"{safe_name}_{tag}.pdf"
-            subprocess.run(["wkhtmltopdf", str(html_path), str(pdf_path)], check=True)
-        except Exception:
-            pass
-
-        summary_rows.append({"conductor": driver, "viajes": viajes, "bruto": bruto, "comision": comision, "neto": neto})
+            futures = {name: ex.submit(render_driver_report, *args) for name, (_, args) in jobs.items()}
+            for name, fut in futures.items():
+                try:
+                    fut.result()
+                    manifest[name] = jobs[name][0]
+                except Exception as e:
+                    manifest.pop(name, None)
+                    print(f"Aviso: no se pudo generar el informe de {name}: {e}")
+        finally:
+            if pool is None:
+                ex.shutdown()
+        tmp = manifest_path.with_name(manifest_path.name + ".tmp")
+        tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=1), encoding="utf-8")
+        os.replace(tmp, manifest_path)
+    DRIVER_REPORTS[tag] = {"generados": len(jobs), "sin_cambios": skipped, "pdf": bool(engine)}
+    print(f"[{tag}] Informes por conductor: {len(jobs)} generados | {skipped} sin cambios")
     return pd.DataFrame(summary_rows)
 
-def main():
+EXCEL_MAX_ROWS = 1_048_576  # filas por hoja de XLSX, cabecera incluida
+EXCEL_CHUNK = 50_000  # filas convertidas a objetos Python de cada vez
+OUTPUT_FORMATS = ("xlsx", "parquet", "csv.gz")
+
+def excel_parts(name: str, df: pd.DataFrame):
+    """Parte `df` en hojas de como mucho EXCEL_MAX_ROWS - 1 filas: Detalle, Detalle_2, ..."""
+    step = EXCEL_MAX_ROWS - 1
+    if len(df) <= step:
+        return [(name, df)]
+    return [(name if i == 0 else f"{name}_{i // step + 1}", df.iloc[i:i + step]) for i in range(0, len(df), step)]
+
+def excel_rows(df: pd.DataFrame):
+    """Filas como listas de valores Python (None en los vacíos), por bloques de EXCEL_CHUNK."""
+    for start in range(0, len(df), EXCEL_CHUNK):
+        chunk = df.iloc[start:start + EXCEL_CHUNK]
+        cols = [chunk[c].astype(object).where(chunk[c].notna(), None).tolist() for c in chunk.columns]
+        yield from zip(*cols)
+
+def write_xlsx(path: Path, sheets):
+    """XLSX con xlsxwriter en modo constant_memory: cada fila va a disco al escribir la siguiente."""
+    tmp = path.with_name(path.name + ".tmp")
+    try:
+        import xlsxwriter
+    except ImportError:
+        with pd.ExcelWriter(tmp, engine="openpyxl") as xw:
+            for name, df in sheets:
+                df.to_excel(xw, index=False, sheet_name=name)
+        os.replace(tmp, path)
+        return
+    wb = xlsxwriter.Workbook(str(tmp), {"constant_memory": True, "default_date_format": "yyyy-mm-dd hh:mm:ss"})
+    bold = wb.add_format({"bold": True})
+    for name, df in sheets:
+        ws = wb.add_worksheet(name)
+        ws.write_row(0, 0, [str(c) for c in df.columns], bold)
+        for n, row in enumerate(excel_rows(df), 1):
+            ws.write_row(n, 0, row)
+    wb.close()
+    os.replace(tmp, path)
+
+def write_table(path: Path, df: pd.DataFrame, fmt: str):
+    tmp = path.with_name(path.name + ".tmp")
+    if fmt == "parquet":
+        df.to_parquet(tmp, index=False)
+    else:
+        df.to_csv(tmp, index=False, compression="gzip")
+    os.replace(tmp, path)
+
+def write_summary_outputs(df: pd.DataFrame, summary: pd.DataFrame, tag: str, formats=("xlsx",), summary_only: bool = False):
+    """Escribe <tag>_resumen_general y el detalle en los formatos pedidos; devuelve las rutas.
+
+    - xlsx: Resumen + Detalle (repartido en Detalle_2, ... si pasa del límite de filas);
+    - parquet / csv.gz: <tag>_resumen_general.* y <tag>_detalle.*.
+    `summary_only` no escribe el detalle en ningún formato.
+    """
+    paths = []
+    for fmt in formats:
+        try:
+            if fmt == "xlsx":
+                path = OUT / f"{tag}_resumen_general.xlsx"
+                write_xlsx(path, [("Resumen", summary)] + ([] if summary_only else excel_parts("Detalle", df)))
+                paths.append(path)
+                continue
+            path = OUT / f"{tag}_resumen_general.{fmt}"
+            write_table(path, summary, fmt)
+            paths.append(path)
+            if not summary_only:
+                path = OUT / f"{tag}_detalle.{fmt}"
+                write_table(path, df, fmt)
+                paths.append(path)
+        except ImportError as e:
+            print(f"Aviso: formato {fmt} no disponible ({e})")
+    return paths
+
+def output_formats(value: str):
+    formats = [f.strip().lower() for f in value.split(",") if f.strip()]
+    unknown = [f for f in formats if f not in OUTPUT_FORMATS]
+    if unknown or not formats:
+        raise argparse.ArgumentTypeError(f"formatos válidos: {', '.join(OUTPUT_FORMATS)}")
+    return formats
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Pipeline de facturas VTM / Talixo")
+    ap.add_argument("--workers", type=int, default=1, help="procesos para extraer PDFs en paralelo (0 = todos los núcleos)")
+    ap.add_argument("--rebuild", action="store_true", help="ignora la caché de extracción y vuelve a extraer todos los PDFs")
+    ap.add_argument("--no-cache", action="store_true", help="no lee ni escribe la caché de extracción")
+    ap.add_argument("--stream", action="store_true", help="extrae página a página hacia un fichero en data/ (en serie); solo la extracción tiene "
+                    "memoria acotada: las filas se vuelven a leer enteras para tarifas, resumen e informes")
+    ap.add_argument("--report-workers", type=int, default=4, help="hilos para generar los informes por conductor")
+    ap.add_argument("--formats", type=output_formats, default=["xlsx"], help="salidas del resumen separadas por comas: xlsx, parquet, csv.gz")
+    ap.add_argument("--solo-resumen", action="store_true", help="no escribe el detalle de viajes (ni hoja Detalle ni fichero *_detalle)")
+    ap.add_argument("--providers", type=lambda v: [x.strip() for x in v.split(",") if x.strip()], default=None,
+                    help="providers a procesar separados por comas (por defecto, todos los de proveedores.json)")
+    ap.add_argument("--watch", action="store_true", help="se queda vigilando las carpetas de entrada e ingiere cada PDF nuevo")
+    ap.add_argument("--debounce", type=float, default=2.0, help="segundos sin cambios antes de procesar un PDF en --watch")
+    ap.add_argument("--publicar-cada", type=float, default=30.0, help="en --watch, segundos mínimos entre reescrituras de las salidas "
+                    "completas (CSV bruto, resumen, detalle) mientras sigan llegando PDFs")
+    ap.add_argument("--poll-interval", type=float, default=2.0, help="segundos entre sondeos si no hay inotify (--watch)")
+    ap.add_argument("--sin-historial", action="store_true", help="no añade los viajes al histórico Parquet de data/historial")
+    ap.add_argument("--cache-max-age", type=float, default=90, help="días sin uso tras los que se borra una entrada de la caché")
+    args = ap.parse_args(argv)
+    unknown = [p for p in args.providers or [] if p not in PROVIDERS]
+    if unknown:
+        ap.error(f"providers desconocidos: {', '.join(unknown)} (registrados: {', '.join(PROVIDERS)})")
+    return args
+
+def driver_summary(df: pd.DataFrame) -> pd.DataFrame:
+    return df.groupby("conductor", dropna=False).agg(
+        viajes=("conductor","count"),
+        bruto=("bruto","sum"),
+        comision=("comision","sum"),
+        neto=("neto","sum"),
+    ).reset_index()
+
+HISTORIAL = {}  # provider -> viajes nuevos / duplicados en el histórico (informe_ejecucion_*.json)
+
+def store_history(df: pd.DataFrame, provider: Provider, args):
+    """Guarda en el histórico las facturas de `df` nuevas o cambiadas (ver historial.guardar)."""
+    if args.sin_historial or df.empty:
+        return
+    if not historial.disponible():
+        print(f"[{provider.name}] Historial omitido: falta pyarrow")
+        return
+    res = historial.guardar(df, provider.name, HISTORIAL_DIR)
+    HISTORIAL[provider.name] = res
+    print(f"[{provider.name}] Historial: {res['nuevos']} viajes guardados, {res['retirados']} retirados "
+          f"({res['sin_cambios']} sin cambios en {res['facturas']} facturas)")
+
+def provider_summary(df: pd.DataFrame, provider: Provider, args) -> pd.DataFrame:
+    """Resumen por conductor de las facturas de `df`.
+
+    Si el histórico está guardado, se suman sus rollups por factura (solo las de esta
+    ejecución, las mismas filas que el Detalle); si no, se agrupa `df`.
+    """
+    if args.sin_historial or provider.name not in HISTORIAL:
+        return driver_summary(df)
+    return historial.resumen_conductores(HISTORIAL_DIR, provider.name, df["factura"].unique())
+
+def driver_months(facturas, provider: Provider, args) -> dict:
+    """conductor -> totales por mes de `facturas`, del rollup (para los informes por conductor)."""
+    if args.sin_historial or provider.name not in HISTORIAL:
+        return None
+    meses = historial.rollup(HISTORIAL_DIR, "mes", provider.name, facturas=facturas)
+    meses = meses.assign(periodo=meses["periodo"].dt.strftime("%Y-%m").fillna("sin fecha"), km=meses["km"].round(1),
+                         **{c: meses[c].round(2) for c in ("bruto", "comision", "neto")})
+    return {driver: g.drop(columns=["provider", "conductor"]) for driver, g in meses.groupby("conductor", sort=False)}
+
+def run_provider(provider: Provider, args, workers: int, extract_pool=None, report_pool=None):
+    """collect -> enrich -> resumen -> informes de un provider; devuelve las rutas generadas."""
+    df = collect_from_folder(provider.input_dir, provider.name, workers, not args.no_cache, args.rebuild, args.stream, extract_pool)
+    if df.empty:
+        return []
+    df = enrich_and_totals(df, provider.engine)
+    store_history(df, provider, args)
+    df.to_csv(DATA / f"{provider.tag}_raw_{TODAY}.csv", index=False)
+    generados = write_summary_outputs(df, provider_summary(df, provider, args), provider.tag, args.formats, args.solo_resumen)
+    save_per_driver_reports(df, provider.drivers_dir, provider.tag, args.report_workers, report_pool, driver_months(df["factura"].unique(), provider, args))
+    return generados
+
+def collect_pdf(pdf: Path, provider: str, use_cache: bool = True) -> pd.DataFrame:
+    """Filas normalizadas de un solo PDF (caché de extracción incluida); lo usa --watch."""
+    key = cache_path(file_sha256(pdf), provider) if use_cache else None
+    if key is not None and key.exists():
+        cached = cache_load(key)
+        if cached is not None:
+            return cached
+    tables = extract_tables_pages(pdf, provider=provider)
+    rows = normalize_tables(tables, provider) if tables else tabula_fallback([pdf], provider)[0]
+    df = pd.concat(rows, ignore_index=True) if rows else pd.DataFrame(columns=EMPTY_COLUMNS)
+    if key is not None:
+        cache_store(key, df)
+    return df
+
+# inotify(7) por ctypes: está en Linux y Android (Termux) sin dependencias extra
+IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x8, 0x40, 0x80, 0x100, 0x200
+IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class FolderWatcher:
+    """PDFs creados, modificados o borrados en unas carpetas.
+
+    Usa inotify si está disponible y, si no, compara (tamaño, mtime) de las carpetas
+    cada `poll_interval` segundos. changes() devuelve rutas "sucias": quién decide
+    si un fichero ya está completo es el debounce de watch_folders.
+    """
+
+    def __init__(self, folders, poll_interval: float = 2.0):
+        self.folders = [Path(f) for f in folders]
+        self.poll_interval = poll_interval
+        self.fd = None
+        self.wds = {}
+        try:
+            self._init_inotify()
+        except Exception as e:
+            self.fd = None
+            print(f"inotify no disponible ({e}); se sondean las carpetas cada {poll_interval:g} s")
+        self._snapshot = self._scan() if self.fd is None else {}
+
+    @property
+    def mode(self) -> str:
+        return "inotify" if self.fd is not None else "sondeo"
+
+    def _init_inotify(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        for folder in self.folders:
+            wd = libc.inotify_add_watch(fd, str(folder).encode(), mask)
+            if wd < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch {folder}")
+            self.wds[wd] = folder
+        self.fd = fd
+
+    def _scan(self):
+        snapshot = {}
+        for folder in self.folders:
+            for pdf in folder.glob("*.pdf"):
+                try:
+                    st = pdf.stat()
+                except FileNotFoundError:
+                    continue
+                snapshot[pdf] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def changes(self, timeout: float):
+        if self.fd is None:
+            time.sleep(min(timeout, self.poll_interval))
+            snapshot = self._scan()
+            changed = {p for p in snapshot.keys() | self._snapshot.keys() if snapshot.get(p) != self._snapshot.get(p)}
+            self._snapshot = snapshot
+            return changed
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        pos = 0
+        while pos + INOTIFY_EVENT.size <= len(data):
+            wd, _, _, length = INOTIFY_EVENT.unpack_from(data, pos)
+            name = data[pos + INOTIFY_EVENT.size:pos + INOTIFY_EVENT.size + length].rstrip(b"\0").decode(errors="replace")
+            pos += INOTIFY_EVENT.size + length
+            if wd in self.wds and name.endswith(".pdf"):
+                changed.add(self.wds[wd] / name)
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def retract_history(provider: Provider, factura: str, args):
+    """Quita del histórico (y de sus rollups) una factura que al reingestarse ya no tiene viajes.
+
+    Borrar o mover el PDF no la retira: como en modo batch, el histórico conserva todos
+    los viajes procesados y solo se reemplazan los de una factura cuando se vuelve a leer.
+    """
+    if args.sin_historial or not historial.disponible():
+        return
+    n = historial.retirar_factura(provider.name, factura, HISTORIAL_DIR)
+    if n:
+        print(f"[{provider.name}] Historial: {n} viajes de {factura} retirados")
+
+SUMMARY_MEASURES = ["viajes", "bruto", "comision", "neto"]
+
+def add_summary(totals: pd.DataFrame, summary: pd.DataFrame, sign: int = 1) -> pd.DataFrame:
+    """Suma (o resta, sign=-1) el resumen por conductor de un PDF a los totales del provider."""
+    delta = summary.set_index("conductor")[SUMMARY_MEASURES] * sign
+    totals = delta if totals is None else totals.add(delta, fill_value=0)
+    return totals[totals["viajes"] > 0]
+
+def publish_provider(provider: Provider, frames: dict, totals: pd.DataFrame, args):
+    """Reescribe el CSV bruto y las salidas del provider desde sus filas en memoria y sus totales."""
+    parts = [f for f in frames.values() if len(f)]
+    if not parts:
+        return []
+    df = pd.concat(parts, ignore_index=True)
+    df.to_csv(DATA / f"{provider.tag}_raw_{TODAY}.csv", index=False)
+    summary = totals.sort_index().reset_index().astype({"viajes": "int64"})
+    return write_summary_outputs(df, summary, provider.tag, args.formats, args.solo_resumen)
+
+def watch_folders(providers, args) -> int:
+    """Modo --watch: ingesta continua de los PDFs que lleguen a las carpetas de los providers.
+
+    Arranca con los PDFs existentes (desde la caché de extracción). Después, cada PDF
+    nuevo, modificado o borrado solo mueve su delta: su resumen por conductor se suma
+    (o se resta) a los totales del provider y se regeneran los informes de los
+    conductores afectados. Al histórico solo llegan las filas de ese PDF, que reemplazan
+    las que tuviera la factura; un PDF borrado sale de las salidas pero no del histórico
+    (ver retract_history). Las salidas
+    completas (CSV bruto, resumen y detalle) se reescriben una vez por ráfaga: cuando
+    no queda nada pendiente o, como mucho, cada `args.publicar_cada` segundos. Un
+    fichero se procesa cuando su (tamaño, mtime) lleva `args.debounce` segundos sin cambiar.
+    """
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+    by_folder = {p.input_dir.resolve(): p for p in providers}
+    frames = {p.name: {} for p in providers}  # provider -> pdf -> filas enriquecidas
+    sums = {p.name: {} for p in providers}  # provider -> pdf -> resumen por conductor de ese PDF
+    totals = {p.name: None for p in providers}  # provider -> totales por conductor (índice conductor)
+    dirty, published = set(), {}
+    use_cache = not args.no_cache
+
+    def ingest(provider: Provider, pdf: Path):
+        df = collect_pdf(pdf, provider.name, use_cache).assign(factura=pdf.name)
+        return enrich_and_totals(df, provider.engine) if len(df) else df
+
+    def publish(name: str):
+        publish_provider(PROVIDERS[name], frames[name], totals[name], args)
+        dirty.discard(name)
+        published[name] = time.monotonic()
+
+    for provider in providers:
+        for pdf in sorted(provider.input_dir.glob("*.pdf")):
+            f = frames[provider.name][pdf] = ingest(provider, pdf)
+            if len(f):
+                sums[provider.name][pdf] = driver_summary(f)
+                totals[provider.name] = add_summary(totals[provider.name], sums[provider.name][pdf])
+        parts = [f for f in frames[provider.name].values() if len(f)]
+        if not parts:
+            continue
+        df = pd.concat(parts, ignore_index=True)
+        store_history(df, provider, args)
+        publish(provider.name)
+        facturas = [pdf.name for pdf in frames[provider.name]]
+        save_per_driver_reports(df, provider.drivers_dir, provider.tag, args.report_workers, months=driver_months(facturas, provider, args))
+
+    watcher = FolderWatcher([p.input_dir for p in providers], args.poll_interval)
+    print(f"Vigilando {', '.join(str(p.input_dir) for p in providers)} ({watcher.mode}); Ctrl+C para salir")
+    pending = {}  # pdf -> ((tamaño, mtime), desde cuándo no cambia)
+    try:
+        while not stop.is_set():
+            for path in watcher.changes(0.5 if pending else 1.0):
+                pending[path] = None
+            now = time.monotonic()
+            ready, removed = [], []
+            for path, seen in list(pending.items()):
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    pending.pop(path)
+                    removed.append(path)
+                    continue
+                firma = (st.st_size, st.st_mtime_ns)
+                if seen is None or seen[0] != firma:
+                    pending[path] = (firma, now)
+                elif now - seen[1] >= args.debounce:
+                    pending.pop(path)
+                    ready.append(path)
+            touched = {}
+            for path in ready + removed:
+                provider = by_folder.get(path.parent.resolve())
+                if provider is None:
+                    continue
+                name = provider.name
+                old = frames[name].pop(path, None)
+                drivers = touched.setdefault(name, set())
+                if old is not None:
+                    drivers.update(old["conductor"])
+                    previo = sums[name].pop(path, None)  # None si el PDF no tenía filas
+                    if previo is not None:
+                        totals[name] = add_summary(totals[name], previo, -1)
+                    dirty.add(name)
+                new = None
+                if path in ready:
+                    t = time.perf_counter()
+                    try:
+                        new = ingest(provider, path)
+                    except Exception as e:
+                        print(f"[{name}] Error procesando {path.name}: {e}")
+                if new is None:
+                    if old is not None:
+                        print(f"[{name}] {path.name} eliminado" if path in removed else f"[{name}] {path.name} retirado")
+                    continue
+                frames[name][path] = new
+                if new.empty:
+                    retract_history(provider, path.name, args)
+                    print(f"[{name}] {path.name}: sin filas")
+                    continue
+                sums[name][path] = driver_summary(new)
+                totals[name] = add_summary(totals[name], sums[name][path])
+                dirty.add(name)
+                drivers.update(new["conductor"])
+                store_history(new, provider, args)
+                print(f"[{name}] {path.name}: {len(new)} filas en {time.perf_counter() - t:.1f} s")
+            for name, drivers in touched.items():
+                provider = PROVIDERS[name]
+                rows = [f[f["conductor"].isin(drivers)] for f in frames[name].values() if len(f)]
+                report_df = pd.concat(rows, ignore_index=True) if rows else None
+                if report_df is not None and len(report_df):
+                    facturas = [pdf.name for pdf in frames[name]]
+                    save_per_driver_reports(report_df, provider.drivers_dir, provider.tag, args.report_workers,
+                                            months=driver_months(facturas, provider, args))
+            # Salidas completas: una vez por ráfaga de PDFs, no una por PDF
+            for name in list(dirty):
+                if not pending or time.monotonic() - published.get(name, 0) >= args.publicar_cada:
+                    publish(name)
+    finally:
+        watcher.close()
+        for name in list(dirty):
+            publish(name)
+    print("Modo watch detenido.")
+    return 0
+
+def main(argv=None):
+    args = parse_args(argv)
+    workers = args.workers or os.cpu_count() or 1
     ensure_dirs()
-    # VTM
-    vtm_df = collect_from_folder(IN_VTM, "vtm")
-    if not vtm_df.empty:
-        vtm_df = enrich_and_totals(vtm_df)
-        vtm_raw = DATA / f"vtm_raw_{TODAY}.csv"
-        vtm_df.to_csv(vtm_raw, index=False)
-
-        # Resumen general
-        vtm_summary = vtm_df.groupby("conductor", dropna=False).agg(
-            viajes=("conductor","count"),
-            bruto=("bruto","sum"),
-            comision=("comision","sum"),
-            neto=("neto","sum"),
-        ).reset_index()
-        with pd.ExcelWriter(OUT / "vtm_resumen_general.xlsx") as xw:
-            vtm_summary.to_excel(xw, index=False, sheet_name="Resumen")
-            vtm_df.to_excel(xw, index=False, sheet_name="Detalle")
-
-        # Reportes por conductor
-        save_per_driver_reports(vtm_df, OUT_VTM_DRIVERS, "vtm")
-
-    # TALIXO
-    tal_df = collect_from_folder(IN_TALIXO, "talixo")
-    if not tal_df.empty:
-        tal_df = enrich_and_totals(tal_df)
-        tal_raw = DATA / f"talixo_raw_{TODAY}.csv"
-        tal_df.to_csv(tal_raw, index=False)
-
-        tal_summary = tal_df.groupby("conductor", dropna=False).agg(
-            viajes=("conductor","count"),
-            bruto=("bruto","sum"),
-            comision=("comision","sum"),
-            neto=("neto","sum"),
-        ).reset_index()
-        with pd.ExcelWriter(OUT / "talixo_resumen_general.xlsx") as xw:
-            tal_summary.to_excel(xw, index=False, sheet_name="Resumen")
-            tal_df.to_excel(xw, index=False, sheet_name="Detalle")
-
-        save_per_driver_reports(tal_df, OUT_TALIXO_DRIVERS, "talixo")
-
-    # Mensaje final
-    print("OK - Pipeline completado.")
-    print(f"VTM PDFs: {len(list(IN_VTM.glob('*.pdf')))} | TALIXO PDFs: {len(list(IN_TALIXO.glob('*.pdf')))}")
-    if (OUT / 'vtm_resumen_general.xlsx').exists():
-        print('Generado:', OUT / 'vtm_resumen_general.xlsx')
-    if (OUT / 'talixo_resumen_general.xlsx').exists():
-        print('Generado:', OUT / 'talixo_resumen_general.xlsx')
-    print('Reportes por conductor en:', OUT_VTM_DRIVERS, 'y', OUT_TALIXO_DRIVERS)
+    if not args.no_cache:
+        cache_evict(args.cache_max_age)
+    selected = [PROVIDERS[name] for name in (args.providers or PROVIDERS)]
+    if args.watch:
+        return watch_folders(selected, args)
+
+    # Pools compartidos por todos los providers: añadir uno no multiplica procesos ni hilos
+    extract_pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 and not args.stream else None
+    report_pool = ThreadPoolExecutor(max_workers=max(1, args.report_workers))
+    generados, fallidos = [], []
+    try:
+        if extract_pool:
+            extract_pool.submit(int).result()  # arranca los procesos desde el hilo principal
+        with ThreadPoolExecutor(max_workers=max(1, len(selected))) as orchestrator:
+            futures = {p.name: orchestrator.submit(run_provider, p, args, workers, extract_pool, report_pool) for p in selected}
+            for name, fut in futures.items():
+                try:
+                    generados += fut.result()
+                except Exception as e:
+                    fallidos.append(name)
+                    print(f"[{name}] Error: {e}")
+    finally:
+        report_pool.shutdown()
+        if extract_pool:
+            extract_pool.shutdown()
+
+    # Mensaje final e informe de ejecución
+    report_path = OUT / f"informe_ejecucion_{TODAY}.json"
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump({"fecha": datetime.datetime.now().isoformat(timespec="seconds"), "extraccion": RUN_REPORT, "informes_conductor": DRIVER_REPORTS,
+                   "historial": HISTORIAL,
+                   "fallidos": fallidos}, f, ensure_ascii=False, indent=2)
+    print("OK - Pipeline completado." if not fallidos else f"Pipeline completado con errores en: {', '.join(fallidos)}")
+    print(" | ".join(f"{p.name.upper()} PDFs: {len(list(p.input_dir.glob('*.pdf')))}" for p in selected))
+    for path in generados:
+        print('Generado:', path)
+    print('Reportes por conductor en:', ", ".join(str(p.drivers_dir) for p in selected))
+    print('Informe de ejecución:', report_path)
+    return 1 if fallidos else 0
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())
@@ -5,18 +5,30 @@ source /root/miniforge/etc/profile.d/conda.sh
 conda activate starlab311
 cd "$PROJECT"
 
+# Uso: tools/run_pipeline.sh [--setup] [opciones del pipeline, p.ej. --watch]
+# --setup reinstala dependencias y prueba a instalar wkhtmltopdf; sin él solo se
+# instalan los módulos que falten (una comprobación de imports, sin pip ni apt).
+SETUP=0
+if [[ "${1:-}" == "--setup" ]]; then
+  SETUP=1
+  shift
+fi
+
 # Dependencias suaves (pdf, excel, html→pdf opcional)
-python - <<'PY'
-import sys, subprocess
-pkgs = ["pdfplumber","tabula-py","pandas","openpyxl","jinja2","xlrd","XlsxWriter"]
-# instalación ligera y silenciosa
-subprocess.run([sys.executable,"-m","pip","install","--quiet","--no-input","--disable-pip-version-check","--no-color","--no-python-version-warning",*pkgs], check=False)
+SETUP="$SETUP" python - <<'PY'
+import importlib.util, os, sys, subprocess
+pkgs = {"pdfplumber": "pdfplumber", "tabula-py": "tabula", "pandas": "pandas", "openpyxl": "openpyxl",
+        "jinja2": "jinja2", "xlrd": "xlrd", "XlsxWriter": "xlsxwriter"}
+faltan = [p for p, mod in pkgs.items() if os.environ["SETUP"] == "1" or importlib.util.find_spec(mod) is None]
+if faltan:
+    # instalación ligera y silenciosa
+    subprocess.run([sys.executable,"-m","pip","install","--quiet","--no-input","--disable-pip-version-check","--no-color","--no-python-version-warning",*faltan], check=False)
 PY
 
 # wkhtmltopdf opcional (para PDF bonitos). Si no está, seguimos.
-if ! command -v wkhtmltopdf >/dev/null 2>&1; then
+if [[ "$SETUP" == "1" ]] && ! command -v wkhtmltopdf >/dev/null 2>&1; then
   apt-get update -y >/dev/null 2>&1 || true
   apt-get install -y wkhtmltopdf >/dev/null 2>&1 || true
 fi
 
-python tools/pipeline_vtm_talixo.py
+exec python tools/pipeline_vtm_talixo.py "$@"